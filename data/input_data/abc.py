@@ -1,37 +1,911 @@
+import contextlib
 import gzip
+import hashlib
+import io
 import json
+import os
+import re
+import shutil
+import itertools
+import tarfile
+import threading
+import time
+from collections import Counter, deque, namedtuple
+from collections.abc import Mapping
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+import numpy as np
 import pandas as pd
 import datetime
 
+try:
+    import resource
+except ImportError:  # Not available on Windows; peak RSS is then not reported.
+    resource = None
 
-def load_gzipped_json(file_path):
+
+# Number of decompressed bytes inspected to decide how a file is laid out.
+SNIFF_BYTES = 4096
+GZIP_MAGIC = b'\x1f\x8b'
+# ustar archives carry their magic at a fixed offset inside the first 512-byte header.
+TAR_MAGIC = b'ustar'
+TAR_MAGIC_OFFSET = 257
+# Size of the decompressed blocks handed to each worker in parallel loads.
+CHUNK_BYTES = 8 * 1024 * 1024
+# Where load_collection keeps its Feather copies of the converted DataFrames.
+CACHE_DIR = 'data/cache'
+# Bump when the layout of cached frames changes in a way SCHEMAS does not show.
+SCHEMA_VERSION = 1
+# How duplicate documents are dropped per collection, see dedupe_records.
+DEDUPE_POLICIES = {'users': {'key': '_id', 'keep': 'latest', 'order_by': 'lastLogin'}}
+# Field whose epoch-ms value only grows when a record changes, per collection
+# that supports incremental refreshes.
+WATERMARK_FIELDS = {'receipts': 'modifyDate'}
+# Column identifying the rows each working DataFrame replaces on upsert.
+UPSERT_KEYS = {'receipts': '_id', 'rewardsReceiptItemList_df': 'receipt_id'}
+# Schema in SCHEMAS of each working DataFrame.
+FRAME_SCHEMAS = {'receipts': 'receipts', 'users': 'users', 'brands': 'brands',
+                 'rewardsReceiptItemList_df': 'receipt_items', 'cpg_df': 'cpg'}
+# Source collection each working DataFrame is split from, see split_collection.
+FRAME_SOURCES = {'receipts': 'receipts', 'rewardsReceiptItemList_df': 'receipts',
+                 'users': 'users', 'brands': 'brands', 'cpg_df': 'brands'}
+# Key domains shared by the working DataFrames, as (frame, column) pairs whose
+# values are drawn from the same set of keys, see build_join_index.
+JOIN_KEYS = {
+    'user': [('users', '_id'), ('receipts', 'userId')],
+    'receipt': [('receipts', '_id'), ('rewardsReceiptItemList_df', 'receipt_id')],
+    'brand': [('brands', '_id')],
+    'barcode': [('brands', 'barcode'), ('rewardsReceiptItemList_df', 'barcode')],
+    'brandCode': [('brands', 'brandCode'), ('rewardsReceiptItemList_df', 'brandCode')],
+}
+# How receipt items are matched to brands, tried in order: (item column, brand
+# column, name of the normalizer in KEY_NORMALIZERS), see match_items_to_brands.
+BRAND_MATCH_RULES = [
+    ('barcode', 'barcode', 'strip'),
+    ('brandCode', 'brandCode', 'brand_code'),
+]
+# HyperLogLog precision of the distinct-user sketches in receipt cubes: 2**12
+# one-byte registers per cell, for a standard error of about 1.6%.
+HLL_PRECISION = 12
+# brand_id of the cube rows that aggregate whole receipts across all brands.
+ALL_BRANDS = '*'
+# Scale of 'cents' columns: prices such as "26.00" are stored as 2600.
+CENTS_PER_UNIT = 100
+# Where export_arrow_store writes the shared, memory-mappable working tables.
+ARROW_STORE_DIR = 'data/arrow_store'
+# Stage records collected by the innermost active profile_stages, or None when
+# profiling is off.
+_STAGE_RECORDS = None
+
+
+def _peak_rss():
     """
-    Load a gzipped JSON file and return a DataFrame.
-    
-    The function first attempts to load the file using pd.read_json assuming JSON Lines format.
-    If that fails, it falls back to manually parsing each line with json.loads.
-    It also skips any header lines that start with the file's base name.
+    Return the peak resident set size of this process in bytes, or None if unknown.
+    """
+    if resource is None:
+        return None
+    # ru_maxrss is in KiB on Linux but in bytes on macOS.
+    scale = 1 if os.uname().sysname == 'Darwin' else 1024
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale
+
+
+@contextlib.contextmanager
+def profile_stages():
+    """
+    Record every pipeline stage run inside the with block and yield the list of records.
+
+    Each record is a dict with the stage name, its start offset and wall time, the
+    CPU time of the thread that ran it, rows and rows/sec, bytes in, and how much
+    the peak RSS grew during the stage (peak_rss_delta_bytes). Peak RSS is
+    process-wide, so stages running concurrently in other threads (see
+    load_collections) share their growth. Stages nest, e.g. each
+    convert[<column>] stage runs inside its load_gzipped_json stage. Only stages run
+    in this process are recorded, not those inside the workers of a parallel load.
+    See write_stage_report for exporting the records.
+    """
+    global _STAGE_RECORDS
+    previous = _STAGE_RECORDS
+    _STAGE_RECORDS = records = []
+    try:
+        yield records
+    finally:
+        _STAGE_RECORDS = previous
+
+
+@contextlib.contextmanager
+def stage(name, rows=None, bytes_in=None):
+    """
+    Time the with block as one pipeline stage when profile_stages is active.
+
+    Yields a dict whose 'rows' and 'bytes_in' entries the block may fill in once it
+    knows them. Without an active profile_stages nothing is measured.
     """
+    info = {'rows': rows, 'bytes_in': bytes_in}
+    records = _STAGE_RECORDS
+    if records is None:
+        yield info
+        return
+    rss_start = _peak_rss()
+    cpu_start = time.thread_time()
+    wall_start = time.perf_counter()
     try:
-        # Attempt to read the file assuming JSON Lines format
-        df = pd.read_json(file_path, compression='gzip', lines=True)
+        yield info
+    finally:
+        wall = time.perf_counter() - wall_start
+        cpu = time.thread_time() - cpu_start
+        rss_end = _peak_rss()
+        rows = info['rows']
+        records.append({
+            'stage': name,
+            'start_s': wall_start,
+            'wall_s': wall,
+            'cpu_s': cpu,
+            'rows': rows,
+            'rows_per_s': rows / wall if rows and wall else None,
+            'bytes_in': info['bytes_in'],
+            'peak_rss_delta_bytes': None if rss_start is None else rss_end - rss_start,
+            'thread': threading.get_ident(),
+        })
+
+
+def stage_report(records):
+    """
+    Summarize stage records as {'stages': [...], 'totals': {name: {...}}}.
+
+    Start offsets are made relative to the first stage, and totals add up the
+    wall/CPU time, rows and bytes of every stage with the same name.
+    """
+    origin = min((record['start_s'] for record in records), default=0)
+    stages = [dict(record, start_s=record['start_s'] - origin) for record in records]
+    totals = {}
+    for record in records:
+        total = totals.setdefault(record['stage'], {'calls': 0, 'wall_s': 0.0, 'cpu_s': 0.0,
+                                                    'rows': 0, 'bytes_in': 0})
+        total['calls'] += 1
+        for field in ('wall_s', 'cpu_s', 'rows', 'bytes_in'):
+            total[field] += record[field] or 0
+    return {'stages': stages, 'totals': totals}
+
+
+def chrome_trace(records):
+    """
+    Convert stage records to the Chrome trace event format, which chrome://tracing
+    and Perfetto display as nested spans per thread.
+    """
+    origin = min((record['start_s'] for record in records), default=0)
+    pid = os.getpid()
+    events = []
+    for record in records:
+        args = {field: record[field] for field in
+                ('rows', 'rows_per_s', 'bytes_in', 'cpu_s', 'peak_rss_delta_bytes')
+                if record[field] is not None}
+        events.append({'name': record['stage'], 'ph': 'X', 'pid': pid, 'tid': record['thread'],
+                       'ts': (record['start_s'] - origin) * 1e6, 'dur': record['wall_s'] * 1e6,
+                       'args': args})
+    return {'traceEvents': events, 'displayTimeUnit': 'ms'}
+
+
+def write_stage_report(records, path, trace_format='report'):
+    """
+    Write stage records to path as JSON, either as a stage_report ('report') or as
+    a Chrome trace ('chrome').
+    """
+    data = chrome_trace(records) if trace_format == 'chrome' else stage_report(records)
+    with open(path, 'w') as f:
+        json.dump(data, f, indent=2)
+
+
+def sniff_format(head):
+    """
+    Guess the container format of a decompressed stream from its first few KB.
+
+    Returns 'tar' for ustar archives (users.json.gz is a tar stream inside gzip),
+    'json' for a single JSON array and 'jsonl' for newline-delimited JSON records.
+    """
+    if head[TAR_MAGIC_OFFSET:TAR_MAGIC_OFFSET + len(TAR_MAGIC)] == TAR_MAGIC:
+        return 'tar'
+    if head.lstrip()[:1] == b'[':
+        return 'json'
+    return 'jsonl'
+
+
+class _PrefixedStream(io.RawIOBase):
+    """
+    Raw stream that replays the sniffed head bytes before continuing with the
+    underlying stream, so sniffing never forces a second decompression pass.
+    """
+
+    def __init__(self, head, stream):
+        self._head = memoryview(head)
+        self._stream = stream
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        if self._head:
+            n = min(len(buffer), len(self._head))
+            buffer[:n] = self._head[:n]
+            self._head = self._head[n:]
+            return n
+        return self._stream.readinto(buffer)
+
+
+def _sniff_stream(raw):
+    """
+    Sniff a binary stream and return (format, stream) ready to be read from the start.
+
+    The sniffed bytes are replayed through _PrefixedStream rather than re-read.
+    gzip data, including concatenated gzip members, is inflated on the fly and
+    sniffed again, so gzip files and gzipped tar members are handled alike.
+    """
+    head = raw.read(SNIFF_BYTES)
+    stream = io.BufferedReader(_PrefixedStream(head, raw))
+    if head[:len(GZIP_MAGIC)] == GZIP_MAGIC:
+        return _sniff_stream(gzip.GzipFile(fileobj=stream))
+    return sniff_format(head), stream
+
+
+def collection_name(path):
+    """
+    Name of the collection stored at path, e.g. 'users' for 'data/users.json.gz'.
+    """
+    name = os.path.basename(path)
+    for suffix in ('.gz', '.jsonl', '.json'):
+        if name.endswith(suffix):
+            name = name[:-len(suffix)]
+    return name
+
+
+# Flat stand-in for a MongoDB DBRef such as {'$id': {'$oid': ...}, '$ref': 'Cogs'}.
+DBRef = namedtuple('DBRef', ['id', 'ref'])
+
+
+def decode_extended_json(obj):
+    """
+    json object_hook that unwraps MongoDB extended-JSON wrappers while parsing.
+
+    {'$oid': ...} becomes the id string, {'$date': ...} its epoch milliseconds and
+    {'$id': ..., '$ref': ...} a DBRef tuple. Hooks run innermost first, so the
+    ObjectId inside a DBRef is already a string by the time the DBRef is seen.
+    Every other dict is returned unchanged.
+    """
+    if len(obj) <= 2:
+        if '$oid' in obj:
+            return obj['$oid']
+        if '$date' in obj:
+            return obj['$date']
+        if '$ref' in obj and '$id' in obj:
+            return DBRef(obj['$id'], obj['$ref'])
+    return obj
+
+
+def _iter_json_lines(stream, file_path, object_hook=None):
+    """
+    Parse each non-empty line of a binary stream with json.loads.
+
+    Malformed lines are skipped, and the number skipped is reported once the
+    stream is exhausted.
+    """
+    skipped = 0
+    for line in stream:
+        if not line.strip():
+            continue
+        try:
+            yield json.loads(line, object_hook=object_hook)
+        except json.JSONDecodeError:
+            skipped += 1
+    if skipped:
+        print(f"Skipped {skipped} malformed lines in {file_path}")
+
+
+def _iter_streams(file_path):
+    """
+    Yield (format, name, stream) for each JSON stream in file_path, reading it once.
+
+    The container format is sniffed from the first SNIFF_BYTES of the decompressed
+    stream: plain JSON Lines ('jsonl'), a single JSON array ('json'), or a tar
+    archive such as users.json.gz. Tar archives are read in streaming mode through
+    tarfile and yield one stream per regular member, named after the member, so
+    nothing is extracted to disk and no header bytes leak into the JSON. Any other
+    file yields a single stream named after file_path.
+    """
+    with open(file_path, 'rb') as raw:
+        file_format, stream = _sniff_stream(raw)
+        if file_format != 'tar':
+            yield file_format, file_path, stream
+            return
+        with tarfile.open(fileobj=stream, mode='r|') as tar:
+            for member in tar:
+                if not member.isfile():
+                    continue
+                member_format, member_stream = _sniff_stream(tar.extractfile(member))
+                if member_format == 'tar':
+                    print(f"Skipping nested tar archive {member.name} in {file_path}")
+                    continue
+                yield member_format, member.name, member_stream
+
+
+def _parse_json_document(stream, object_hook=None):
+    """
+    Parse a whole JSON document and return its records as a list.
+    """
+    data = json.load(stream, object_hook=object_hook)
+    return data if isinstance(data, list) else [data]
+
+
+def _decode_value(value, object_hook):
+    """
+    Apply object_hook bottom-up to every object inside a parsed value, as the JSON
+    parser does when given the hook.
+    """
+    if isinstance(value, dict):
+        return object_hook({key: _decode_value(item, object_hook) for key, item in value.items()})
+    if isinstance(value, list):
+        return [_decode_value(item, object_hook) for item in value]
+    return value
+
+
+def project_record(record, columns, object_hook=None):
+    """
+    Keep only the listed top-level fields of a record parsed without object_hook,
+    then run object_hook over what is kept.
+
+    The result equals parsing with object_hook and dropping the other fields, but
+    the hook never runs over the dropped ones, such as the nested item lists.
+    """
+    if not isinstance(record, dict):
+        return record
+    record = {col: record[col] for col in columns if col in record}
+    if object_hook is None:
+        return record
+    return _decode_value(record, object_hook)
+
+
+# Comparison operators accepted in loader filters, see normalize_filters.
+FILTER_OPERATORS = {
+    '==': lambda value, operand: value == operand,
+    '!=': lambda value, operand: value != operand,
+    '<': lambda value, operand: value < operand,
+    '<=': lambda value, operand: value <= operand,
+    '>': lambda value, operand: value > operand,
+    '>=': lambda value, operand: value >= operand,
+    'in': lambda value, operand: value in operand,
+    'not in': lambda value, operand: value not in operand,
+}
+
+
+def _filter_operand(operand):
+    """
+    Bring a filter operand into the form fields take after decode_extended_json:
+    dates and timestamps become epoch milliseconds, naive ones read as UTC.
+    """
+    if isinstance(operand, (datetime.date, pd.Timestamp, np.datetime64)):
+        timestamp = pd.Timestamp(operand)
+        if timestamp.tzinfo is None:
+            timestamp = timestamp.tz_localize('UTC')
+        return timestamp.value // 1_000_000
+    return operand
+
+
+def normalize_filters(filters):
+    """
+    Check and normalize loader filters, a list of (field, operator, operand) tuples
+    that must all hold, e.g. [('rewardsReceiptStatus', '==', 'FINISHED'),
+    ('dateScanned', '>=', datetime.datetime(2021, 1, 1))].
+
+    Operators are the keys of FILTER_OPERATORS; 'in' and 'not in' take a
+    collection of operands. Returns None for no filters.
+    """
+    if not filters:
+        return None
+    normalized = []
+    for field, op, operand in filters:
+        if op not in FILTER_OPERATORS:
+            raise ValueError(f"Unknown filter operator {op!r} for {field}")
+        if op in ('in', 'not in'):
+            operand = frozenset(_filter_operand(item) for item in operand)
+        else:
+            operand = _filter_operand(operand)
+        normalized.append((field, op, operand))
+    return normalized
+
+
+def _filter_value(value, operand):
+    """
+    Make a parsed field comparable with a filter operand: raw extended-JSON
+    wrappers are unwrapped, and numbers sent as strings ("26.00") become floats
+    when compared with a number. Returns None when that is impossible.
+    """
+    if isinstance(value, dict):
+        value = value.get('$date', value.get('$oid'))
+    if isinstance(value, str) and isinstance(operand, (int, float)) and not isinstance(operand, bool):
+        try:
+            return float(value)
+        except ValueError:
+            return None
+    return value
+
+
+def record_matches(record, filters):
+    """
+    Return whether a parsed record passes every normalized filter.
+
+    As in SQL, a record missing a field, or holding null or an incomparable value
+    in it, fails every filter on that field, '!=' and 'not in' included.
+    """
+    for field, op, operand in filters:
+        sample = next(iter(operand), None) if op in ('in', 'not in') else operand
+        value = _filter_value(record.get(field), sample)
+        if value is None:
+            return False
+        try:
+            if not FILTER_OPERATORS[op](value, operand):
+                return False
+        except TypeError:
+            return False
+    return True
+
+
+def filter_records(records, filters):
+    """
+    Yield the records that pass every normalized filter.
+    """
+    if not filters:
+        yield from records
+        return
+    for record in records:
+        if isinstance(record, dict) and record_matches(record, filters):
+            yield record
+
+
+def _iter_stream_records(file_format, stream, file_path, object_hook=None, columns=None):
+    """
+    Yield the records of one stream produced by _iter_streams, projected to columns
+    if given (see project_record).
+    """
+    hook = object_hook if columns is None else None
+    if file_format == 'json':
+        records = _parse_json_document(stream, hook)
+    else:
+        records = _iter_json_lines(stream, file_path, hook)
+    if columns is None:
+        yield from records
+    else:
+        for record in records:
+            yield project_record(record, columns, object_hook)
+
+
+def iter_json_records(file_path, object_hook=None, columns=None, filters=None):
+    """
+    Yield every JSON record in file_path, decompressing and parsing it exactly once.
+
+    See _iter_streams for the container formats understood. object_hook is handed
+    to the JSON parser for every object. columns keeps only those top-level fields
+    of each record, see project_record, and filters only the records passing them,
+    see normalize_filters. Filtered fields must be among the columns.
+    """
+    filters = normalize_filters(filters)
+    for file_format, _, stream in _iter_streams(file_path):
+        yield from filter_records(
+            _iter_stream_records(file_format, stream, file_path, object_hook, columns), filters)
+
+
+def _iter_line_blocks(stream, chunk_bytes):
+    """
+    Cut a JSON Lines stream into blocks of about chunk_bytes that end on a line break.
+    """
+    while True:
+        block = stream.read(chunk_bytes)
+        if not block:
+            return
+        yield block + stream.readline()
+
+
+def _build_frame(records, schema, strict=False):
+    """
+    Build a DataFrame from parsed records, converting it when a schema is given.
+    """
+    with stage('build_frame', rows=len(records)):
+        df = pd.DataFrame(records)
+    if schema is not None:
+        df = apply_conversions(df, schema, strict)
+    return df
+
+
+def _convert_block(records, schema, strict=False, split=None, drop=()):
+    """
+    Build the converted DataFrame of a block of records. With split, a collection
+    name, the columns in drop are removed and the block is split by
+    split_collection, so that nested columns such as rewardsReceiptItemList are
+    flattened where the block was parsed.
+    """
+    df = _build_frame(records, schema, strict)
+    if split is None:
         return df
-    except ValueError as e:
-        print(f"pd.read_json failed for {file_path}: {e}")
-        # Fallback: manually parse each line
-        data = []
-        # Get the base name (e.g., 'users.json' becomes 'users.json' without '.gz')
-        base_name = file_path.split("/")[-1].replace(".gz", "")
-        with gzip.open(file_path, 'rt', encoding='utf-8') as f:
-            for line in f:
-                # Skip empty lines and lines that start with the base name (likely header lines)
-                if line.strip() and not line.startswith(base_name):
-                    try:
-                        data.append(json.loads(line))
-                    except json.JSONDecodeError:
-                        continue
-        return pd.DataFrame(data)
-        
+    return split_collection(split, df.drop([col for col in drop if col in df.columns], axis=1))
+
+
+def _parse_block(block, file_path, object_hook, schema, columns=None, filters=None,
+                 strict=False, split=None, drop=()):
+    """
+    Parse one block of JSON Lines into a DataFrame, or a dict of them with split
+    (see _convert_block). Runs inside the worker processes.
+    """
+    records = _iter_stream_records('jsonl', block.splitlines(), file_path, object_hook, columns)
+    return _convert_block(list(filter_records(records, filters)), schema, strict, split, drop)
+
+
+def concat_frames(frames, schema):
+    """
+    Concatenate per-chunk DataFrames in order and restore the schema dtypes that
+    concatenation can lose, e.g. categories that differ from chunk to chunk, which
+    pd.concat turns into object columns. Use it to join the chunks of iter_chunks.
+    The bad_values counts of the chunks are added up in df.attrs['bad_values'].
+    """
+    bad_values = Counter()
+    for df in frames:
+        bad_values.update(df.attrs.get('bad_values', {}))
+    frames = [df for df in frames if len(df.columns)]
+    if not frames:
+        return pd.DataFrame()
+    df = pd.concat(frames, ignore_index=True)
+    df.attrs.pop('bad_values', None)
+    if bad_values:
+        df.attrs['bad_values'] = dict(bad_values)
+    if schema is not None:
+        for col, dtype in get_schema(schema).items():
+            if col in df.columns and dtype == 'category' and df[col].dtype != 'category':
+                df[col] = df[col].astype('category')
+    return df
+
+
+def _load_parallel(file_path, object_hook, schema, workers, chunk_bytes, columns=None,
+                   filters=None, strict=False, split=None, drop=()):
+    """
+    Parse file_path in chunk_bytes blocks across a pool of worker processes.
+
+    The parent process only inflates the file, cuts it into blocks and
+    concatenates the results; parsing and conversion happen in the workers. At
+    most two blocks per worker are in flight, and results are collected in
+    submission order, so rows keep their file order.
+
+    Each result is pickled back to the parent, where unpickling the Python
+    objects of a nested column costs about a third of parsing the block. With
+    split the workers also split their blocks (see _convert_block), so only flat,
+    typed columns come back, which unpickle over ten times faster, and the
+    result is a dict of concatenated frames.
+    """
+    frames = []
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        pending = deque()
+        for file_format, _, stream in _iter_streams(file_path):
+            if file_format == 'json':
+                records = list(filter_records(_iter_stream_records(
+                    file_format, stream, file_path, object_hook, columns), filters))
+                pending.append(pool.submit(_convert_block, records, schema, strict, split, drop))
+                continue
+            for block in _iter_line_blocks(stream, chunk_bytes):
+                pending.append(pool.submit(_parse_block, block, file_path, object_hook, schema,
+                                           columns, filters, strict, split, drop))
+                if len(pending) >= 2 * workers:
+                    frames.append(pending.popleft().result())
+        frames.extend(future.result() for future in pending)
+    if split is None:
+        return concat_frames(frames, schema)
+    names = dict.fromkeys(name for parts in frames for name in parts)
+    return {name: concat_frames([parts[name] for parts in frames if name in parts],
+                                schema if name == split else FRAME_SCHEMAS.get(name))
+            for name in names}
+
+
+_OID_PATTERN = re.compile(r'[0-9a-f]{24}')
+
+
+def _compact_key(value):
+    """
+    Return a smaller hashable stand-in for an ObjectId string: the int of its 96
+    bits, which takes about half the memory of the 24-character str in a set.
+    """
+    if isinstance(value, str) and _OID_PATTERN.fullmatch(value):
+        return int(value, 16)
+    return value
+
+
+def _order_value(value):
+    """
+    Comparable form of an order_by value, unwrapping raw {'$date': ...} dicts.
+    """
+    if isinstance(value, dict):
+        return value.get('$date')
+    return value
+
+
+def dedupe_records(records, key='_id', keep='first', order_by=None, stats=None):
+    """
+    Drop records whose key was already seen.
+
+    keep='first' keeps the first record of each key and streams: only the compact
+    keys seen so far are held, so it runs over inputs larger than memory.
+    keep='latest' keeps, for each key, the record with the greatest order_by value
+    (missing values count as oldest, ties go to the earlier record); it has to hold
+    the kept records until the input is exhausted. Either way records come out in
+    the order their key first appeared, and records without a key are never
+    dropped. The number of dropped records is stored in stats['duplicates_dropped']
+    when a stats dict is given.
+    """
+    dropped = 0
+    if keep == 'first':
+        seen = set()
+        for record in records:
+            record_key = _compact_key(record.get(key))
+            if record_key is not None:
+                if record_key in seen:
+                    dropped += 1
+                    continue
+                seen.add(record_key)
+            yield record
+    elif keep == 'latest':
+        kept = []
+        positions = {}
+        for record in records:
+            record_key = _compact_key(record.get(key))
+            position = positions.get(record_key) if record_key is not None else None
+            if position is None:
+                if record_key is not None:
+                    positions[record_key] = len(kept)
+                kept.append(record)
+                continue
+            dropped += 1
+            new = _order_value(record.get(order_by))
+            old = _order_value(kept[position].get(order_by))
+            if new is not None and (old is None or new > old):
+                kept[position] = record
+        yield from kept
+    else:
+        raise ValueError(f"Unknown keep policy: {keep!r}")
+    if stats is not None:
+        stats['duplicates_dropped'] = dropped
+
+
+def dedupe_frame(df, key='_id', keep='first', order_by=None):
+    """
+    DataFrame counterpart of dedupe_records with the same policies and row order,
+    used once the chunks of a parallel load have been concatenated.
+
+    Returns the deduplicated DataFrame and the number of rows dropped.
+    """
+    if key not in df.columns:
+        return df, 0
+    keys = df[key]
+    positions = np.arange(len(df))
+    has_key = keys.notna().to_numpy()
+    if keep == 'first':
+        duplicated = keys.duplicated().to_numpy() & has_key
+        return df[~duplicated].reset_index(drop=True), int(duplicated.sum())
+    if keep != 'latest':
+        raise ValueError(f"Unknown keep policy: {keep!r}")
+    ranked = pd.DataFrame({'key': keys.to_numpy()[has_key], 'pos': positions[has_key]})
+    ranked['order'] = (df[order_by].to_numpy()[has_key] if order_by in df.columns
+                       else np.full(len(ranked), np.nan))
+    first_seen = ranked.groupby('key', sort=False)['pos'].transform('min')
+    ranked = ranked.assign(first_seen=first_seen)
+    ranked = ranked.sort_values(['order', 'pos'], ascending=[False, True],
+                                na_position='last', kind='stable')
+    winners = ranked.drop_duplicates('key')
+    order = np.concatenate([winners['first_seen'].to_numpy(), positions[~has_key]])
+    rows = np.concatenate([winners['pos'].to_numpy(), positions[~has_key]])
+    rows = rows[np.argsort(order, kind='stable')]
+    return df.iloc[rows].reset_index(drop=True), len(df) - len(rows)
+
+
+def _get_dedupe_policy(dedupe):
+    """
+    Resolve dedupe to keyword arguments for dedupe_records: a collection name in
+    DEDUPE_POLICIES, or a dict of the arguments themselves.
+    """
+    if isinstance(dedupe, str):
+        return DEDUPE_POLICIES[dedupe]
+    return dedupe
+
+
+def _policy_fields(policy):
+    """
+    Return the fields a dedupe policy reads from each record.
+    """
+    if policy is None:
+        return []
+    return [field for field in (policy.get('key', '_id'), policy.get('order_by')) if field]
+
+
+def _parse_columns(columns, policy, filters):
+    """
+    Return (columns, parse_columns): the requested columns as a list (or None for
+    all) and the columns to parse, which add the fields the dedupe policy and the
+    filters read.
+    """
+    if columns is None:
+        return None, None
+    columns = list(columns)
+    needed = _policy_fields(policy) + [field for field, _, _ in filters or ()]
+    return columns, columns + [field for field in dict.fromkeys(needed) if field not in columns]
+
+
+def _report_duplicates(df, dropped, file_path):
+    """
+    Print and record on df.attrs how many duplicates a dedupe policy dropped.
+    """
+    print(f"Dropped {dropped} duplicate records from {file_path}")
+    df.attrs['duplicates_dropped'] = dropped
+
+
+def _records_to_frame(records, file_path, schema, policy, filters=None, strict=False):
+    """
+    Deduplicate records by policy (if any), keep those passing the normalized
+    filters, and build the converted DataFrame.
+    """
+    stats = {}
+    if policy is not None:
+        records = dedupe_records(records, stats=stats, **policy)
+    records = filter_records(records, filters)
+    with stage(f'parse[{file_path}]') as info:
+        records = list(records)
+        info['rows'] = len(records)
+    df = _build_frame(records, schema, strict)
+    if policy is not None:
+        _report_duplicates(df, stats['duplicates_dropped'], file_path)
+    return df
+
+
+def load_gzipped_json(file_path, object_hook=decode_extended_json, schema=None,
+                      workers=None, chunk_bytes=CHUNK_BYTES, dedupe=None, columns=None,
+                      filters=None, strict=False, split=None):
+    """
+    Load a gzipped JSON file and return a DataFrame.
+
+    The file is decompressed and parsed in a single pass by iter_json_records, which
+    sniffs whether it holds JSON Lines, a JSON array or a tar archive (as users.json.gz
+    does) instead of retrying with a different parser after a failure.
+
+    By default extended-JSON wrappers are flattened by decode_extended_json while
+    parsing, so no {'$oid': ...} or {'$date': ...} dicts end up in the cells. Pass
+    object_hook=None to keep the raw documents.
+
+    When schema is given (a collection name in SCHEMAS or a {field: dtype} dict),
+    the DataFrame is returned already converted by apply_conversions.
+
+    With workers > 1 the decompressed stream is cut into blocks of about chunk_bytes
+    and parsed in a ProcessPoolExecutor of that many processes. The result is the
+    same DataFrame, in the same row order, as a serial load. object_hook must then
+    be picklable, i.e. a module-level function.
+
+    dedupe drops duplicate documents, e.g. the repeated users in users.json.gz: pass
+    a collection name in DEDUPE_POLICIES or a dict of dedupe_records arguments. The
+    number of rows dropped is reported and kept in df.attrs['duplicates_dropped'].
+
+    columns projects every record to those top-level fields as it is parsed, so the
+    other fields, e.g. the nested rewardsReceiptItemList, never reach the DataFrame
+    and are neither decoded nor converted. Columns missing from every record are
+    left out of the result.
+
+    filters, e.g. [('rewardsReceiptStatus', '==', 'FINISHED'), ('dateScanned', '>=',
+    datetime.datetime(2021, 1, 1))], are evaluated on each record as it is parsed
+    (see normalize_filters and record_matches), so rejected records never enter a
+    DataFrame. With a dedupe policy they apply to the deduplicated records, and
+    the load is then serial, since a worker cannot tell which duplicate survives.
+
+    Numbers that fail to parse are masked and counted in df.attrs['bad_values'],
+    see apply_conversions; with strict they raise ValueError instead.
+
+    split, a collection name, returns split_collection(split, df) instead of df.
+    Without a dedupe policy, a parallel load then splits every block in its
+    worker, so nested columns such as rewardsReceiptItemList are never sent
+    back to the parent; build_collection loads this way.
+    """
+    policy = _get_dedupe_policy(dedupe)
+    filters = normalize_filters(filters)
+    columns, parse_columns = _parse_columns(columns, policy, filters)
+    if filters and policy is not None:
+        workers = None
+    with stage(f'load_gzipped_json[{file_path}]', bytes_in=os.path.getsize(file_path)) as info:
+        if workers is None or workers <= 1:
+            df = _records_to_frame(iter_json_records(file_path, object_hook, parse_columns),
+                                   file_path, schema, policy, filters, strict)
+        elif split is not None and policy is None:
+            drop = [col for col in parse_columns or () if col not in columns]
+            frames = _load_parallel(file_path, object_hook, schema, workers, chunk_bytes,
+                                    parse_columns, filters, strict, split, drop)
+            info['rows'] = len(frames.get(split, ()))
+            return frames or {split: pd.DataFrame()}
+        else:
+            df = _load_parallel(file_path, object_hook, schema, workers, chunk_bytes,
+                                parse_columns, filters, strict)
+            if policy is not None:
+                df, dropped = dedupe_frame(df, **policy)
+                _report_duplicates(df, dropped, file_path)
+        if parse_columns != columns:
+            df = df.drop([col for col in parse_columns if col not in columns and col in df.columns],
+                         axis=1)
+        info['rows'] = len(df)
+    return df if split is None else split_collection(split, df)
+
+
+def iter_chunks(file_path, chunksize=100_000, object_hook=decode_extended_json, schema=None,
+                dedupe=None, columns=None, filters=None, strict=False):
+    """
+    Yield file_path as DataFrames of at most chunksize rows, parsing it lazily so
+    that only one chunk of records is held in memory at a time.
+
+    The arguments mean the same as for load_gzipped_json, and each chunk is
+    converted the same way, so concat_frames(chunks, schema) gives the eager
+    result; the row index runs on from chunk to chunk, and columns keep the order
+    of earlier chunks. With a schema, every chunk carries all of its fields (within
+    columns, if given), missing ones as empty columns of the declared dtype.
+    Categories are those of the chunk, so a plain pd.concat of the chunks turns
+    category columns into object ones; concat_frames restores them. Receipt items
+    can be normalized chunk by chunk, as each receipt keeps its items.
+
+    dedupe with keep='first' streams; keep='latest' holds the kept records until
+    the input is exhausted, so the first chunk only comes after the whole file.
+    """
+    policy = _get_dedupe_policy(dedupe)
+    filters = normalize_filters(filters)
+    columns, parse_columns = _parse_columns(columns, policy, filters)
+    stats = {}
+    records = iter_json_records(file_path, object_hook, parse_columns)
+    if policy is not None:
+        records = dedupe_records(records, stats=stats, **policy)
+    records = filter_records(records, filters)
+    fields = []
+    if schema is not None:
+        fields = [col for col in get_schema(schema) if columns is None or col in columns]
+    start = 0
+    order = []
+    while True:
+        batch = list(itertools.islice(records, chunksize))
+        if not batch:
+            break
+        with stage(f'chunk[{file_path}]') as info:
+            df = pd.DataFrame(batch, index=pd.RangeIndex(start, start + len(batch)))
+            del batch
+            if parse_columns is not None:
+                df = df.drop([col for col in df.columns if col not in columns], axis=1)
+            for col in fields:
+                if col not in df.columns:
+                    df[col] = pd.Series(None, index=df.index, dtype=object)
+            if schema is not None:
+                df = apply_conversions(df, schema, strict)
+            # Keep the column order of earlier chunks, appending new columns.
+            order.extend(col for col in df.columns if col not in order)
+            df = df[[col for col in order if col in df.columns]]
+            info['rows'] = len(df)
+        start += len(df)
+        yield df
+    if policy is not None:
+        print(f"Dropped {stats['duplicates_dropped']} duplicate records from {file_path}")
+
+
+def load_archive(file_path, object_hook=decode_extended_json, convert=True):
+    """
+    Load every collection of a (gzipped) tar archive in one sequential read.
+
+    Returns {collection name: DataFrame}, naming each member with collection_name,
+    so an archive holding users.json and brands.json yields 'users' and 'brands'.
+    Members of the same collection are concatenated. With convert, collections
+    registered in SCHEMAS are converted and deduplicated by their DEDUPE_POLICIES
+    entry, as build_collection does. A plain JSON file yields a single collection.
+    """
+    records = {}
+    for file_format, member_name, stream in _iter_streams(file_path):
+        name = collection_name(member_name)
+        records.setdefault(name, []).extend(
+            _iter_stream_records(file_format, stream, file_path, object_hook))
+    frames = {}
+    for name, collection_records in records.items():
+        schema = name if convert and name in SCHEMAS else None
+        policy = DEDUPE_POLICIES.get(name) if convert else None
+        frames[name] = _records_to_frame(collection_records, f'{file_path}:{name}', schema, policy)
+    return frames
+
 
 def convert_oid(value):
     """
@@ -68,67 +942,1714 @@ def convert_cpg(value):
     return value
 
 
-def apply_conversions(df):
-    """
-    Apply conversions to a DataFrame by converting MongoDB ObjectIDs and dates.
-    
-    This function checks for known columns that may contain ObjectIDs (like '_id', 'userId', etc.)
-    and known date columns, and applies the corresponding conversion functions.
-    """
-    # Convert ObjectID columns if they exist.
-    oid_columns = ['_id', 'userId', 'brand_id']
-    for col in oid_columns:
-        if col in df.columns:
-            df[col] = df[col].apply(convert_oid)
-    
-    # Define a list of common date column names
-    date_columns = ['createdDate', 'lastLogin', 'purchaseDate', 'dateScanned', 'finishedDate', 'modifyDate', 'pointsAwardedDate']
-    for col in date_columns:
-        if col in df.columns:
-            df[col] = df[col].apply(convert_date)
-
-    if 'cpg' in df.columns:
-        df['cpg'] = df['cpg'].apply(convert_cpg)
-    
-    return df
+def _unwrap(series, key):
+    """
+    Pull key out of every {key: value} wrapper in series in one pass.
 
+    Returns an object array where each wrapper has been replaced by its value
+    (everything else is left as is, like the convert_* functions do) and a
+    boolean mask marking which entries were wrappers.
+    """
+    values = series.to_numpy(dtype=object, copy=True)
+    mask = np.fromiter((isinstance(v, dict) and key in v for v in values),
+                       dtype=bool, count=len(values))
+    values[mask] = [v[key] for v in values[mask]]
+    return values, mask
 
 
+def epoch_ms_to_datetime(epoch_ms, tz=None):
+    """
+    Convert an int64 array of epoch milliseconds to a datetime64[ms] DatetimeIndex.
+
+    The array is reinterpreted in place rather than converted value by value, and
+    the result is naive UTC, the same on every host whatever its local timezone.
+    Pass tz (e.g. 'America/Chicago') for timezone-aware datetimes in that zone.
+    """
+    dates = pd.DatetimeIndex(np.asarray(epoch_ms, dtype=np.int64).view('datetime64[ms]'))
+    if tz is not None:
+        dates = dates.tz_localize('UTC').tz_convert(tz)
+    return dates
+
+
+def datetime_to_epoch_ms(series):
+    """
+    Return the int64 epoch milliseconds behind a date column decoded by
+    decode_date_column, for fast range filters and bucketing.
+
+    A naive datetime64[ms] column is viewed as int64 without copying. Missing
+    dates come back as the NaT sentinel, np.iinfo(np.int64).min.
+    """
+    if isinstance(series.dtype, pd.DatetimeTZDtype):
+        series = series.dt.tz_convert('UTC').dt.tz_localize(None)
+    return series.to_numpy(dtype='datetime64[ms]').view(np.int64)
+
+
+def _in_timezone(dates, tz):
+    """
+    Convert a naive UTC (or timezone-aware) datetime Series to tz, if tz is given.
+    """
+    if tz is None:
+        return dates
+    if isinstance(dates.dtype, pd.DatetimeTZDtype):
+        return dates.dt.tz_convert(tz)
+    return dates.dt.tz_localize('UTC').dt.tz_convert(tz)
+
+
+def decode_oid_column(series):
+    """
+    Vectorized counterpart of convert_oid for a whole column.
+    """
+    if series.dtype != object:
+        # Already unwrapped at parse time.
+        return series
+    values, _ = _unwrap(series, '$oid')
+    return pd.Series(values, index=series.index, name=series.name)
 
-# Define file paths for each dataset
-file_paths = {
-    'receipts': 'data/input_data/receipts.json.gz',
-    'users': 'data/input_data/users.json.gz',
-    'brands': 'data/input_data/brands.json.gz'
-}
 
+def decode_date_column(series, tz=None):
+    """
+    Vectorized counterpart of convert_date for a whole column.
+
+    The '$date' values are gathered into one int64 epoch-ms array and converted in
+    bulk. Columns holding only date wrappers and missing values come back as
+    datetime64[ms] with NaT for the gaps; any other values are left untouched in an
+    object column, as convert_date would leave them.
+
+    Numeric columns are taken to be epoch milliseconds already unwrapped at parse
+    time by decode_extended_json and are converted directly.
+
+    Unlike convert_date, which uses the local timezone of the host, dates are naive
+    UTC, so a receipt falls in the same month on every worker; datetime_to_epoch_ms
+    gets the int64 epoch back without copying. Pass tz for timezone-aware dates.
+    """
+    if pd.api.types.is_datetime64_any_dtype(series.dtype):
+        return _in_timezone(series, tz)
+    if pd.api.types.is_numeric_dtype(series.dtype):
+        epoch_ms = series.to_numpy(dtype=np.float64, na_value=np.nan)
+        missing = np.isnan(epoch_ms)
+        epoch_ms = np.where(missing, 0, epoch_ms).astype(np.int64)
+        epoch_ms[missing] = np.iinfo(np.int64).min
+        dates = pd.Series(epoch_ms_to_datetime(epoch_ms), index=series.index, name=series.name)
+        return _in_timezone(dates, tz)
+    values, mask = _unwrap(series, '$date')
+    epoch_ms = values[mask].astype('int64')
+    if (mask | pd.isna(values)).all():
+        dates = np.full(len(values), np.datetime64('NaT'), dtype='datetime64[ms]')
+        dates[mask] = epoch_ms_to_datetime(epoch_ms).to_numpy(dtype='datetime64[ms]')
+        return _in_timezone(pd.Series(dates, index=series.index, name=series.name), tz)
+    values[mask] = list(epoch_ms_to_datetime(epoch_ms, tz).to_pydatetime())
+    return pd.Series(values, index=series.index, name=series.name, dtype=object)
+
+
+def decode_dbref_column(series):
+    """
+    Split a DBRef column (e.g. brands' cpg) into '<name>_id' and '<name>_ref' columns.
 
+    Cells may hold DBRef tuples produced by decode_extended_json or raw
+    {'$id': ..., '$ref': ...} dicts, which go through convert_cpg.
+    """
+    ids, refs = [], []
+    for value in series:
+        if isinstance(value, dict):
+            value = convert_cpg(value)
+            value = (value.get('cpg_id'), value.get('cpg_ref'))
+        elif not isinstance(value, DBRef):
+            value = (None, None)
+        ids.append(value[0])
+        refs.append(value[1])
+    return pd.DataFrame({f'{series.name}_id': ids, f'{series.name}_ref': refs},
+                        index=series.index)
+
+
+def _parse_numbers(series, strict=False):
+    """
+    Parse a column of numbers, which arrive as JSON strings ("26.00"), into a
+    float64 array in one vectorized pass.
 
+    Returns (values, bad), where bad marks the present values that are not finite
+    numbers; they are NaN in values. With strict they raise ValueError instead.
+    Blank strings count as missing, not as bad values.
+    """
+    values = pd.Series(pd.to_numeric(series, errors='coerce')).to_numpy(
+        dtype=np.float64, na_value=np.nan, copy=True)
+    bad = series.notna().to_numpy() & ~np.isfinite(values)
+    if bad.any():
+        # Only the few unparsed values are checked for blanks, one by one.
+        blank = np.array([isinstance(value, str) and not value.strip() for value in series[bad]])
+        bad[np.flatnonzero(bad)[blank]] = False
+    if bad.any():
+        if strict:
+            examples = list(series[bad].head(3))
+            raise ValueError(f"{bad.sum()} values of {series.name} are not numbers, e.g. {examples}")
+        values[bad] = np.nan
+    return values, bad
 
-receipts_df = load_gzipped_json('data/input_data/receipts.json.gz')
-rewardsReceiptItemList = receipts_df['rewardsReceiptItemList']
-rewardsReceiptItemList_df = pd.DataFrame(rewardsReceiptItemList)
-receipts_df = receipts_df.drop('rewardsReceiptItemList', axis=1)
 
-users_df = load_gzipped_json('data/input_data/users.json.gz')
+def decode_number_column(series, dtype='float64', strict=False):
+    """
+    Convert a column of numbers sent as strings to a float or nullable int dtype.
 
-brands_df = load_gzipped_json('data/input_data/brands.json.gz')
-cpg = brands_df['cpg']
-cpg_df = pd.DataFrame(cpg)
-brands_df = brands_df.drop('cpg', axis=1)
+    Bad values are masked and their count is kept in result.attrs['bad_values'];
+    with strict they raise ValueError instead. For the int dtypes, numbers with a
+    fraction ("1.5") or out of the dtype's range count as bad values too.
+    """
+    values, bad = _parse_numbers(series, strict)
+    if dtype in ('Int32', 'Int64'):
+        bound = -float(np.iinfo(dtype.lower()).min)
+        inexact = np.isfinite(values) & ((values != np.trunc(values)) | (values < -bound)
+                                         | (values >= bound))
+        if inexact.any():
+            if strict:
+                examples = list(series[inexact].head(3))
+                raise ValueError(f"{inexact.sum()} values of {series.name} are not {dtype} "
+                                 f"integers, e.g. {examples}")
+            values[inexact] = np.nan
+            bad |= inexact
+    result = pd.Series(values, index=series.index, name=series.name).astype(dtype)
+    result.attrs['bad_values'] = int(bad.sum())
+    return result
 
-dataframes = {'receipts':receipts_df, 'users':users_df, 'brands':brands_df, 'rewardsReceiptItemList_df': rewardsReceiptItemList_df, 'cpg_df': cpg_df}
 
+def decode_cents_column(series, strict=False):
+    """
+    Convert a column of prices such as "26.00" to exact int64 cents (2600), as a
+    nullable Int64 column, in one vectorized pass.
+
+    Bad values are masked and counted as in decode_number_column. Prices with
+    fractions of a cent are rounded to the nearest cent, or raise ValueError with
+    strict. An Int64 column is taken to hold cents already and returned as is.
+    """
+    if isinstance(series.dtype, pd.Int64Dtype):
+        result = series.copy(deep=False)
+        result.attrs = {'bad_values': 0}
+        return result
+    values, bad = _parse_numbers(series, strict)
+    scaled = values * CENTS_PER_UNIT
+    cents = np.round(scaled)
+    missing = np.isnan(cents)
+    if strict:
+        inexact = ~missing & (np.abs(scaled - cents) > 1e-6 * np.maximum(1, np.abs(scaled)))
+        if inexact.any():
+            examples = list(series[inexact].head(3))
+            raise ValueError(f"{inexact.sum()} values of {series.name} have fractions of a cent, "
+                             f"e.g. {examples}")
+    data = np.where(missing, 0, cents).astype(np.int64)
+    result = pd.Series(pd.arrays.IntegerArray(data, missing), index=series.index, name=series.name)
+    result.attrs['bad_values'] = int(bad.sum())
+    return result
+
+
+OBJECT_ID_BYTES = 12
+
+
+def _object_id_bytes(series):
+    """
+    Return the ObjectIds of series as a (n, 12) uint8 array plus a validity mask.
+
+    series holds either 24-character hex strings, decoded with a single
+    bytes.fromhex over the whole column, or ids already packed by
+    pack_object_ids, whose buffer is used as is. Missing ids become zero bytes.
+    """
+    if _is_packed_oid(series):
+        import pyarrow as pa
+
+        array = pa.array(series)
+        if isinstance(array, pa.ChunkedArray):
+            array = array.combine_chunks()
+        valid = series.notna().to_numpy()
+        raw = np.frombuffer(array.buffers()[1], dtype=np.uint8)
+        start = array.offset * OBJECT_ID_BYTES
+        raw = raw[start:start + len(array) * OBJECT_ID_BYTES]
+        return raw.reshape(-1, OBJECT_ID_BYTES), valid
+    values = series.to_numpy(dtype=object)
+    valid = pd.notna(values)
+    filled = np.where(valid, values, '0' * 2 * OBJECT_ID_BYTES)
+    if len(filled) and not (pd.Series(filled).str.len() == 2 * OBJECT_ID_BYTES).all():
+        raise ValueError(f"{series.name} holds values that are not 24-character ObjectIds")
+    raw = np.frombuffer(bytes.fromhex(''.join(filled)), dtype=np.uint8)
+    return raw.reshape(-1, OBJECT_ID_BYTES), valid
+
+
+def _packed_oid_type():
+    """
+    Arrow type backing packed ObjectId columns.
+    """
+    import pyarrow as pa
+
+    return pa.binary(OBJECT_ID_BYTES)
+
+
+def _is_packed_oid(series):
+    """
+    Whether series holds ObjectIds packed by pack_object_ids.
+    """
+    dtype = series.dtype
+    return isinstance(dtype, pd.ArrowDtype) and dtype.pyarrow_dtype == _packed_oid_type()
+
+
+def pack_object_ids(series):
+    """
+    Pack a column of ObjectId hex strings into a 12-byte Arrow fixed_size_binary
+    column. Requires pyarrow.
+
+    Measured on receipts._id, an id takes 12 bytes packed against 32 in a pandas
+    str column (three eighths) and 81 as a Python str object (about a seventh).
+    """
+    import pyarrow as pa
+
+    raw, valid = _object_id_bytes(series)
+    array = pa.Array.from_buffers(
+        _packed_oid_type(), len(raw),
+        [pa.py_buffer(np.packbits(valid, bitorder='little')), pa.py_buffer(raw.tobytes())],
+        null_count=int((~valid).sum()))
+    return pd.Series(pd.arrays.ArrowExtensionArray(array), index=series.index, name=series.name)
+
+
+def unpack_object_ids(series):
+    """
+    Turn packed ObjectIds (or hex strings) back into 24-character hex strings.
+    """
+    raw, valid = _object_id_bytes(series)
+    hex_ids = np.frombuffer(raw.tobytes().hex().encode(), dtype=f'S{2 * OBJECT_ID_BYTES}')
+    values = hex_ids.astype(str).astype(object)
+    values[~valid] = np.nan
+    return pd.Series(values, index=series.index, name=series.name)
+
+
+def object_id_words(series):
+    """
+    Split ObjectIds into two uint64 columns: the first 8 bytes and the last 4.
+
+    Comparing (hi, lo) pairs orders ids the way MongoDB does, and the pair can be
+    hashed or sorted as plain integers. Missing ids give (0, 0).
+    """
+    raw, _ = _object_id_bytes(series)
+    hi = raw[:, :8].copy().view('>u8').ravel().astype(np.uint64)
+    lo = raw[:, 8:].copy().view('>u4').ravel().astype(np.uint64)
+    return (pd.Series(hi, index=series.index, name=f'{series.name}_hi'),
+            pd.Series(lo, index=series.index, name=f'{series.name}_lo'))
+
+
+def object_id_timestamps(series):
+    """
+    Creation time embedded in each ObjectId (its first 4 bytes, big-endian seconds
+    since the epoch) as a UTC datetime column, without parsing any string.
+    """
+    raw, valid = _object_id_bytes(series)
+    seconds = raw[:, :4].copy().view('>u4').ravel().astype(np.int64)
+    dates = pd.Series(pd.to_datetime(seconds, unit='s', utc=True), index=series.index,
+                      name=series.name)
+    return dates.where(valid)
+
+
+def compact_schema(schema):
+    """
+    Copy of a schema with every 'oid' field declared 'packed_oid' instead, e.g.
+    load_gzipped_json(path, schema=compact_schema('receipts')).
+    """
+    return {field: 'packed_oid' if dtype == 'oid' else dtype
+            for field, dtype in get_schema(schema).items()}
+
+
+# Declared dtype of every field of each collection. 'oid', 'packed_oid', 'dbref',
+# 'cents' and 'list' are handled by this module; every other entry is a pandas
+# dtype. Fields missing from a schema are left as parsed.
+SCHEMAS = {
+    'receipts': {
+        '_id': 'oid',
+        'bonusPointsEarned': 'Int32',
+        'bonusPointsEarnedReason': 'str',
+        'createDate': 'datetime64[ms]',
+        'dateScanned': 'datetime64[ms]',
+        'finishedDate': 'datetime64[ms]',
+        'modifyDate': 'datetime64[ms]',
+        'pointsAwardedDate': 'datetime64[ms]',
+        'pointsEarned': 'float64',
+        'purchaseDate': 'datetime64[ms]',
+        'purchasedItemCount': 'Int32',
+        'rewardsReceiptItemList': 'list',
+        'rewardsReceiptStatus': 'category',
+        'totalSpent': 'cents',
+        'userId': 'oid',
+    },
+    'users': {
+        '_id': 'oid',
+        'active': 'boolean',
+        'createdDate': 'datetime64[ms]',
+        'lastLogin': 'datetime64[ms]',
+        'role': 'category',
+        'signUpSource': 'category',
+        'state': 'category',
+    },
+    'brands': {
+        '_id': 'oid',
+        'barcode': 'str',
+        'brandCode': 'str',
+        'category': 'category',
+        'categoryCode': 'category',
+        'cpg': 'dbref',
+        'cpg_id': 'oid',
+        'cpg_ref': 'category',
+        'name': 'str',
+        'topBrand': 'boolean',
+    },
+    'receipt_items': {
+        'receipt_id': 'oid',
+        'item_index': 'int32',
+        'barcode': 'str',
+        'brandCode': 'str',
+        'competitiveProduct': 'boolean',
+        'competitorRewardsGroup': 'str',
+        'deleted': 'boolean',
+        'description': 'str',
+        'discountedItemPrice': 'cents',
+        'finalPrice': 'cents',
+        'itemNumber': 'str',
+        'itemPrice': 'cents',
+        'metabriteCampaignId': 'str',
+        'needsFetchReview': 'boolean',
+        'needsFetchReviewReason': 'category',
+        'originalFinalPrice': 'cents',
+        'originalMetaBriteBarcode': 'str',
+        'originalMetaBriteDescription': 'str',
+        'originalMetaBriteItemPrice': 'cents',
+        'originalMetaBriteQuantityPurchased': 'Int32',
+        'originalReceiptItemText': 'str',
+        'partnerItemId': 'str',
+        'pointsEarned': 'float64',
+        'pointsNotAwardedReason': 'category',
+        'pointsPayerId': 'oid',
+        'preventTargetGapPoints': 'boolean',
+        'priceAfterCoupon': 'cents',
+        'quantityPurchased': 'Int32',
+        'rewardsGroup': 'str',
+        'rewardsProductPartnerId': 'oid',
+        'targetPrice': 'cents',
+        'userFlaggedBarcode': 'str',
+        'userFlaggedDescription': 'str',
+        'userFlaggedNewItem': 'boolean',
+        'userFlaggedPrice': 'cents',
+        'userFlaggedQuantity': 'Int32',
+    },
+    'cpg': {
+        'cpg': 'dbref',
+        'cpg_id': 'oid',
+        'cpg_ref': 'category',
+    },
+}
+
+
+def get_schema(schema):
+    """
+    Resolve schema to a {field: dtype} dict.
+
+    schema may be a collection name registered in SCHEMAS, a dict of its own, or
+    None for the union of all registered schemas (field names mean the same thing
+    in every collection).
+    """
+    if schema is None:
+        merged = {}
+        for fields in SCHEMAS.values():
+            merged.update(fields)
+        return merged
+    if isinstance(schema, str):
+        return SCHEMAS[schema]
+    return schema
+
+
+def convert_column(series, dtype, strict=False):
+    """
+    Convert a single parsed column to the dtype declared for it in a schema.
+
+    Returns (converted, bad), bad being how many values were masked because they
+    are not numbers; strict makes numeric columns raise ValueError on them
+    instead, see decode_number_column and decode_cents_column.
+    """
+    if dtype == 'oid':
+        return decode_oid_column(series), 0
+    if dtype == 'packed_oid':
+        return pack_object_ids(decode_oid_column(series)), 0
+    if dtype == 'datetime64[ms]':
+        return decode_date_column(series), 0
+    if isinstance(dtype, str) and dtype.startswith('datetime64[ms, '):
+        # Timezone-aware dates, e.g. 'datetime64[ms, America/Chicago]'.
+        return decode_date_column(series, tz=dtype[len('datetime64[ms, '):-1]), 0
+    if dtype in ('str', 'list'):
+        return series, 0
+    if dtype == 'cents':
+        converted = decode_cents_column(series, strict)
+    elif dtype in ('float32', 'float64', 'Int32', 'Int64'):
+        # Numbers such as pointsEarned arrive as JSON strings ("750.0").
+        converted = decode_number_column(series, dtype, strict)
+    else:
+        return series.astype(dtype), 0
+    return converted, converted.attrs['bad_values']
+
+
+def apply_conversions(df, schema=None, strict=False):
+    """
+    Apply conversions to a DataFrame by converting MongoDB ObjectIDs, dates and
+    every other field to the dtype declared for it.
+
+    The declarations come from get_schema(schema): pass a collection name such as
+    'receipts' to use its entry in SCHEMAS. Columns the schema does not mention are
+    left untouched. A DBRef column such as 'cpg' is split into 'cpg_id' and
+    'cpg_ref', which are then converted in turn.
+
+    Numbers that fail to parse are masked; how many per column is printed and
+    kept in df.attrs['bad_values']. strict raises ValueError on them instead.
+    """
+    for col, dtype in get_schema(schema).items():
+        if col not in df.columns:
+            continue
+        with stage(f'convert[{col}]', rows=len(df)):
+            if dtype == 'dbref':
+                refs = decode_dbref_column(df.pop(col))
+                for ref_col in refs.columns:
+                    df[ref_col] = refs[ref_col]
+            else:
+                converted, bad = convert_column(df[col], dtype, strict)
+                if bad:
+                    print(f"Masked {bad} bad values in {col}")
+                    df.attrs.setdefault('bad_values', {})[col] = bad
+                df[col] = converted
+    return df
+
+
+def normalize_receipt_items(receipts_df, schema='receipt_items'):
+    """
+    Flatten the nested rewardsReceiptItemList column into one typed items table.
+
+    Each item becomes a row carrying the '_id' of its receipt as 'receipt_id' and its
+    position in the receipt's list as 'item_index'. Both are computed from the list
+    offsets with np.repeat instead of looping over receipts, and the item fields
+    are then converted with apply_conversions(items, schema). receipt_id keeps the
+    dtype of '_id', so ids packed by compact_schema stay packed.
+    """
+    with stage('extract[rewardsReceiptItemList]', rows=len(receipts_df)):
+        if 'rewardsReceiptItemList' in receipts_df.columns:
+            lists = receipts_df['rewardsReceiptItemList'].to_numpy(dtype=object)
+        else:
+            # No receipt in this frame has items, e.g. a filtered block.
+            lists = np.full(len(receipts_df), None, dtype=object)
+        lengths = np.fromiter((len(v) if isinstance(v, list) else 0 for v in lists),
+                              dtype=np.int64, count=len(lists))
+        offsets = np.concatenate(([0], np.cumsum(lengths)))
+        items = pd.DataFrame(list(itertools.chain.from_iterable(
+            v for v in lists if isinstance(v, list))))
+        rows = np.repeat(np.arange(len(lists)), lengths)
+        items.insert(0, 'receipt_id', receipts_df['_id'].array.take(rows))
+        items.insert(1, 'item_index',
+                     (np.arange(offsets[-1]) - np.repeat(offsets[:-1], lengths)).astype(np.int32))
+    return apply_conversions(items, schema)
+
+
+def split_collection(name, df):
+    """
+    Split a converted collection into the working DataFrames derived from it.
+
+    receipts yields 'receipts' and its normalized items 'rewardsReceiptItemList_df',
+    brands yields 'brands' and the split-off 'cpg_df', and any other collection a
+    single DataFrame under its own name.
+    """
+    if name == 'receipts' and 'rewardsReceiptItemList' in df.columns:
+        items = normalize_receipt_items(df)
+        return {'receipts': df.drop('rewardsReceiptItemList', axis=1),
+                'rewardsReceiptItemList_df': items}
+    if name == 'brands':
+        with stage('extract[cpg]', rows=len(df)):
+            cpg_columns = [col for col in SCHEMAS['cpg'] if col in df.columns and col != 'cpg']
+            return {'brands': df.drop(cpg_columns, axis=1),
+                    'cpg_df': df[cpg_columns].reset_index(drop=True)}
+    return {name: df}
+
+
+def build_collection(name, file_path, **load_kwargs):
+    """
+    Load and convert one source file into the working DataFrames derived from it,
+    dropping duplicates by the collection's DEDUPE_POLICIES entry if it has one.
+    """
+    load_kwargs.setdefault('dedupe', DEDUPE_POLICIES.get(name))
+    return load_gzipped_json(file_path, schema=name, split=name, **load_kwargs)
+
+
+def dataframe_to_arrow(df):
+    """
+    Convert df to an Arrow table for Feather/IPC files. Requires pyarrow.
+
+    Packed ObjectId columns are recorded as plain objects in the pandas metadata,
+    because pandas cannot parse its own name for fixed_size_binary dtypes back;
+    arrow_to_dataframe restores them from the Arrow type instead.
+    """
+    import pyarrow as pa
+
+    table = pa.Table.from_pandas(df, preserve_index=False)
+    metadata = json.loads(table.schema.metadata[b'pandas'])
+    for column in metadata['columns']:
+        if column['numpy_type'].startswith('fixed_size_binary'):
+            column['numpy_type'] = 'object'
+    return table.replace_schema_metadata(
+        {**table.schema.metadata, b'pandas': json.dumps(metadata).encode()})
+
+
+def arrow_to_dataframe(table, zero_copy=False):
+    """
+    Convert an Arrow table written from dataframe_to_arrow back to a DataFrame.
+
+    zero_copy keeps every column as a pd.ArrowDtype view over the Arrow buffers;
+    otherwise the usual pandas dtypes are restored, except packed ObjectIds, which
+    stay Arrow-backed.
+    """
+    import pyarrow as pa
+
+    if zero_copy:
+        return table.to_pandas(types_mapper=pd.ArrowDtype)
+
+    def types_mapper(arrow_type):
+        if pa.types.is_fixed_size_binary(arrow_type):
+            return pd.ArrowDtype(arrow_type)
+        return None
+
+    return table.to_pandas(types_mapper=types_mapper)
+
+
+def _read_frames(entry_dir, names=None, columns=None):
+    """
+    Read back the DataFrames written by _write_frames, or only those in names.
+
+    columns limits every frame read to the listed columns it has, in that order;
+    the files are memory-mapped so the other columns are never read.
+    """
+    from pyarrow import feather
+
+    with open(os.path.join(entry_dir, 'frames.json')) as f:
+        frame_names = json.load(f)
+    frames = {}
+    for frame in frame_names:
+        if names is not None and frame not in names:
+            continue
+        table = feather.read_table(os.path.join(entry_dir, f'{frame}.feather'), memory_map=True)
+        if columns is not None:
+            table = table.select([col for col in columns if col in table.column_names])
+        frames[frame] = arrow_to_dataframe(table)
+    return frames
+
+
+def _write_frames(frames, entry_dir):
+    """
+    Write frames as Feather files into entry_dir, replacing what was there.
+
+    Everything is written to a temporary directory first and swapped in with
+    renames, so readers never see a partial entry.
+    """
+    from pyarrow import feather
+
+    tmp_dir = f'{entry_dir}.tmp'
+    old_dir = f'{entry_dir}.old'
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    os.makedirs(tmp_dir)
+    try:
+        for frame, df in frames.items():
+            feather.write_feather(dataframe_to_arrow(df), os.path.join(tmp_dir, f'{frame}.feather'))
+        with open(os.path.join(tmp_dir, 'frames.json'), 'w') as f:
+            json.dump(list(frames), f)
+    except BaseException:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        raise
+    if os.path.exists(entry_dir):
+        os.replace(entry_dir, old_dir)
+    os.replace(tmp_dir, entry_dir)
+    shutil.rmtree(old_dir, ignore_errors=True)
+
+
+def _hash_file(file_path, block_size=1024 * 1024):
+    """
+    Return the SHA-256 hex digest of a file's contents.
+    """
+    digest = hashlib.sha256()
+    with open(file_path, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def source_fingerprint(file_path, manifest_path):
+    """
+    Return the content hash of file_path, rehashing only when its size or mtime changed.
+
+    The last (size, mtime, hash) triple is kept in manifest_path, so an unchanged
+    input costs one stat() instead of a full read.
+    """
+    stat = os.stat(file_path)
+    try:
+        with open(manifest_path) as f:
+            manifest = json.load(f)
+    except (OSError, ValueError):
+        manifest = {}
+    if manifest.get('size') == stat.st_size and manifest.get('mtime_ns') == stat.st_mtime_ns:
+        return manifest['sha256']
+    manifest = {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns, 'sha256': _hash_file(file_path)}
+    with open(manifest_path, 'w') as f:
+        json.dump(manifest, f)
+    return manifest['sha256']
+
+
+def cache_key(name, file_path, cache_dir):
+    """
+    Key of the cached frames of a collection.
+
+    It covers the content of the source file, SCHEMA_VERSION, the collection's
+    schemas and the source of this module, so editing the input or the conversion
+    code invalidates the cache on the next load.
+    """
+    collection_dir = os.path.join(cache_dir, name)
+    os.makedirs(collection_dir, exist_ok=True)
+    digest = hashlib.sha256()
+    digest.update(source_fingerprint(file_path, os.path.join(collection_dir, 'source.json')).encode())
+    digest.update(str(SCHEMA_VERSION).encode())
+    digest.update(json.dumps(SCHEMAS, sort_keys=True).encode())
+    digest.update(_hash_file(__file__).encode())
+    return digest.hexdigest()[:16]
+
+
+# load_gzipped_json arguments that change how a load runs but not what it returns;
+# any other argument makes load_collection bypass the cache.
+CACHE_NEUTRAL_KWARGS = ('workers', 'chunk_bytes')
+
+
+def load_collection(name, file_path, cache_dir=CACHE_DIR, **load_kwargs):
+    """
+    Return the converted working DataFrames of a collection, using the on-disk cache.
+
+    On a hit the frames are read back from Feather files under
+    cache_dir/<name>/<cache_key>/ with their dtypes intact. On a miss they are built
+    with build_collection, written there, and older entries of the collection are
+    removed. cache_dir=None bypasses the cache. Feather needs pyarrow; without it
+    the frames are simply rebuilt on every call.
+
+    Only the default, complete frames are cached: load_kwargs such as columns,
+    filters, dedupe or object_hook change the result, and strict must see the
+    values a cached entry has already masked, so they bypass the cache
+    altogether (see CACHE_NEUTRAL_KWARGS).
+    """
+    if cache_dir is None or any(arg not in CACHE_NEUTRAL_KWARGS for arg in load_kwargs):
+        return build_collection(name, file_path, **load_kwargs)
+    key = cache_key(name, file_path, cache_dir)
+    collection_dir = os.path.join(cache_dir, name)
+    entry_dir = os.path.join(collection_dir, key)
+    try:
+        with stage(f'cache_read[{name}]'):
+            return _read_frames(entry_dir)
+    except FileNotFoundError:
+        pass
+    except ImportError as e:
+        print(f"Cache disabled for {name}: {e}")
+        return build_collection(name, file_path, **load_kwargs)
+
+    frames = build_collection(name, file_path, **load_kwargs)
+    try:
+        _write_frames(frames, entry_dir)
+    except ImportError as e:
+        print(f"Cache disabled for {name}: {e}")
+        return frames
+    for entry in os.listdir(collection_dir):
+        stale = os.path.join(collection_dir, entry)
+        if os.path.isdir(stale) and entry != key:
+            shutil.rmtree(stale, ignore_errors=True)
+    return frames
+
+
+def iter_records_since(file_path, field, watermark, object_hook=decode_extended_json):
+    """
+    Yield the records of file_path whose field (an extended-JSON date) is newer than
+    watermark, given in epoch milliseconds.
+
+    The date is first read from the raw line with a regular expression, so lines
+    at or below the watermark are skipped without being parsed. Lines where it
+    cannot be found that way are parsed and kept; the upsert is idempotent, so
+    keeping a record that did not change is harmless. watermark=None yields
+    everything.
+    """
+    date_pattern = re.compile(rb'"%s"\s*:\s*\{\s*"\$date"\s*:\s*(-?\d+)' % re.escape(field.encode()))
+
+    def is_new(line):
+        match = date_pattern.search(line)
+        return match is None or int(match.group(1)) > watermark
+
+    for file_format, _, stream in _iter_streams(file_path):
+        if file_format == 'json':
+            records = _parse_json_document(stream, object_hook)
+        else:
+            if watermark is not None:
+                stream = (line for line in stream if is_new(line))
+            records = _iter_json_lines(stream, file_path, object_hook)
+        for record in records:
+            value = record.get(field)
+            if watermark is None or not isinstance(value, int) or value > watermark:
+                yield record
+
+
+def upsert_frame(old, new, key, schema=None, replaced=None):
+    """
+    Replace the rows of old whose key appears in new with the rows of new.
+
+    replaced, if given, lists the keys whose old rows are dropped instead. Child
+    frames such as receipt items need it: a changed receipt may have no items
+    left, so its key would not appear in new at all. Rows of new are appended at
+    the end, and schema dtypes lost by concatenation (e.g. categories) are restored.
+    """
+    if old is None or not len(old.columns):
+        return new if new is not None else pd.DataFrame()
+    if replaced is None:
+        if new is None or not len(new):
+            return old
+        replaced = new[key]
+    kept = old[~old[key].isin(replaced)]
+    return concat_frames([kept] if new is None else [kept, new], schema)
+
+
+def refresh_collection(name, file_path, cache_dir=CACHE_DIR):
+    """
+    Bring the cached working DataFrames of a collection up to date with file_path,
+    parsing only the records changed since the last refresh.
+
+    The cutoff is the high-watermark of WATERMARK_FIELDS[name] kept in
+    cache_dir/incremental/<name>/watermark.json. Changed records are converted,
+    split and upserted by UPSERT_KEYS into the frames stored next to it; a
+    receipt's items are replaced together with the receipt, including when it has
+    none left. The first refresh loads everything. Collections without a
+    watermark field fall back to load_collection.
+    """
+    field = WATERMARK_FIELDS.get(name)
+    if field is None:
+        return load_collection(name, file_path, cache_dir)
+    state_dir = os.path.join(cache_dir, 'incremental', name)
+    watermark_path = os.path.join(state_dir, 'watermark.json')
+    try:
+        with open(watermark_path) as f:
+            watermark = json.load(f)['watermark']
+        frames = _read_frames(os.path.join(state_dir, 'frames'))
+    except FileNotFoundError:
+        watermark, frames = None, {}
+
+    # Later copies of the same _id in the export win.
+    records = {}
+    for record in iter_records_since(file_path, field, watermark):
+        records[record.get('_id')] = record
+    records = list(records.values())
+    if not records:
+        return frames
+    changed = split_collection(name, _build_frame(records, name))
+    # Every frame split from this collection loses the rows of the changed
+    # records, even when the delta holds no new rows for it.
+    replaced = changed[name]['_id']
+    for frame in dict.fromkeys([*frames, *changed]):
+        if FRAME_SOURCES.get(frame, frame) != name:
+            continue
+        key = UPSERT_KEYS.get(frame, '_id')
+        frames[frame] = upsert_frame(frames.get(frame), changed.get(frame), key,
+                                     FRAME_SCHEMAS.get(frame), replaced)
+
+    dates = [record[field] for record in records if isinstance(record.get(field), int)]
+    if dates:
+        watermark = max(dates) if watermark is None else max(watermark, max(dates))
+    os.makedirs(state_dir, exist_ok=True)
+    _write_frames(frames, os.path.join(state_dir, 'frames'))
+    with open(watermark_path, 'w') as f:
+        json.dump({'field': field, 'watermark': watermark}, f)
+    return frames
+
+
+def load_collections(file_paths, cache_dir=CACHE_DIR, max_workers=None, **load_kwargs):
+    """
+    Load every collection in file_paths ({name: path}) concurrently with
+    load_collection and return all their working DataFrames in one dict.
+
+    Each collection is loaded in its own thread. Only the file reads and the gzip
+    inflate release the GIL, so only they overlap across files; JSON parsing and
+    building the frames still run one at a time, and the gain is modest (about
+    10% on the sample data). Frames are returned in file_paths order; the first
+    error raised by a load is re-raised.
+
+    load_kwargs must not ask for workers > 1: forking a process pool from a
+    multithreaded parent can deadlock the children. Load a large collection on
+    its own with load_collection(..., workers=n) instead.
+    """
+    if (load_kwargs.get('workers') or 1) > 1:
+        raise ValueError("load_collections cannot use workers > 1; "
+                         "use load_collection(..., workers=n) per collection")
+    if not file_paths:
+        return {}
+    with ThreadPoolExecutor(max_workers=max_workers or len(file_paths)) as pool:
+        futures = [pool.submit(load_collection, name, file_path, cache_dir, **load_kwargs)
+                   for name, file_path in file_paths.items()]
+        dataframes = {}
+        for future in futures:
+            dataframes.update(future.result())
+    return dataframes
+
+
+def build_projection(frame, file_path, columns, **load_kwargs):
+    """
+    Load only the listed columns of one working DataFrame from its source file.
+
+    Only the requested fields are kept while parsing and then converted, so asking
+    receipts for '_id' and 'totalSpent' decodes neither dates nor the nested items.
+    Columns the frame does not have are left out. Duplicates are dropped by the
+    DEDUPE_POLICIES entry of the source collection, as build_collection does.
+    """
+    source = FRAME_SOURCES.get(frame, frame)
+    load_kwargs.setdefault('dedupe', DEDUPE_POLICIES.get(source))
+    if frame == 'rewardsReceiptItemList_df':
+        parse_columns = ['_id', 'rewardsReceiptItemList']
+    elif frame == 'cpg_df':
+        parse_columns = ['cpg']
+    else:
+        parse_columns = columns
+    df = load_gzipped_json(file_path, columns=parse_columns, **load_kwargs)
+    schema = get_schema(FRAME_SCHEMAS[frame]) if frame in FRAME_SCHEMAS else {}
+    projected = {col: schema[col] for col in columns if col in schema}
+    if frame == 'rewardsReceiptItemList_df':
+        if 'rewardsReceiptItemList' not in df.columns:
+            return pd.DataFrame()
+        df = normalize_receipt_items(df[['_id', 'rewardsReceiptItemList']], projected)
+    elif frame == 'cpg_df':
+        if 'cpg' not in df.columns:
+            return pd.DataFrame()
+        df = apply_conversions(df[['cpg']], {'cpg': 'dbref', **projected})
+    else:
+        df = apply_conversions(df[[col for col in columns if col in df.columns]], projected)
+    return df[[col for col in columns if col in df.columns]]
+
+
+class LazyFrames(Mapping):
+    """
+    Read-only {frame name: DataFrame} mapping of the working DataFrames built from
+    file_paths, where each source collection is loaded on first access.
+
+    Looking up a frame loads, converts and splits its source collection with
+    load_collection (so 'cpg_df' loads brands) and keeps every frame it yields.
+    select(frame, columns) returns just some columns and decodes only those when
+    the frame is not loaded yet. Creating the registry, iterating over it and
+    membership tests such as 'receipts' in frames read nothing.
+    """
+
+    def __init__(self, file_paths, cache_dir=CACHE_DIR, **load_kwargs):
+        self.file_paths = dict(file_paths)
+        self.cache_dir = cache_dir
+        self.load_kwargs = load_kwargs
+        self._frames = {}
+        self._projections = {}
+
+    def _source(self, frame):
+        source = FRAME_SOURCES.get(frame, frame)
+        if source not in self.file_paths:
+            raise KeyError(frame)
+        return source
+
+    def __getitem__(self, frame):
+        if frame not in self._frames:
+            source = self._source(frame)
+            self._frames.update(load_collection(source, self.file_paths[source], self.cache_dir,
+                                                **self.load_kwargs))
+        return self._frames[frame]
+
+    def __contains__(self, frame):
+        # Mapping's default would look the frame up, loading its collection.
+        return frame in self._frames or FRAME_SOURCES.get(frame, frame) in self.file_paths
+
+    def __iter__(self):
+        for frame, source in FRAME_SOURCES.items():
+            if source in self.file_paths:
+                yield frame
+        for source in self.file_paths:
+            if source not in FRAME_SOURCES:
+                yield source
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+    def load_all(self, max_workers=None):
+        """
+        Load every collection not loaded yet, concurrently with load_collections,
+        and return self. A registry loading with workers > 1 loads them one after
+        another instead, each with its own process pool.
+        """
+        missing = {source: file_path for source, file_path in self.file_paths.items()
+                   if not any(FRAME_SOURCES.get(frame, frame) == source for frame in self._frames)}
+        if (self.load_kwargs.get('workers') or 1) > 1:
+            for source, file_path in missing.items():
+                self._frames.update(load_collection(source, file_path, self.cache_dir,
+                                                    **self.load_kwargs))
+        else:
+            self._frames.update(load_collections(missing, self.cache_dir, max_workers,
+                                                 **self.load_kwargs))
+        return self
+
+    def loaded(self):
+        """
+        Return the names of the frames loaded so far.
+        """
+        return list(self._frames)
+
+    def select(self, frame, columns):
+        """
+        Return the listed columns of frame, loading and decoding as little as possible.
+
+        A loaded frame is simply sliced. Otherwise the columns are read from the
+        collection's cache entry if it is current, or else parsed and converted on
+        their own by build_projection. Projections are kept for later calls.
+        """
+        columns = list(columns)
+        if frame in self._frames:
+            df = self._frames[frame]
+            return df[[col for col in columns if col in df.columns]]
+        key = (frame, tuple(columns))
+        if key not in self._projections:
+            self._projections[key] = self._load_projection(frame, columns)
+        return self._projections[key]
+
+    def _load_projection(self, frame, columns):
+        source = self._source(frame)
+        file_path = self.file_paths[source]
+        if self.cache_dir is not None:
+            entry_dir = os.path.join(self.cache_dir, source,
+                                     cache_key(source, file_path, self.cache_dir))
+            try:
+                frames = _read_frames(entry_dir, [frame], columns)
+            except (FileNotFoundError, ImportError):
+                frames = {}
+            if frame in frames:
+                return frames[frame]
+        return build_projection(frame, file_path, columns, **self.load_kwargs)
+
+    def clear(self):
+        """
+        Drop every loaded frame and projection, so the next access reloads them.
+        """
+        self._frames.clear()
+        self._projections.clear()
+
+
+def export_arrow_store(dataframes, store_dir=ARROW_STORE_DIR):
+    """
+    Write each DataFrame of dataframes to store_dir/<name>.arrow as an uncompressed
+    Arrow IPC file, which load_arrow_store can memory-map without copying.
+
+    Files are written under a temporary name and renamed into place, so readers
+    never map a half-written table. Requires pyarrow.
+    """
+    import pyarrow as pa
+
+    os.makedirs(store_dir, exist_ok=True)
+    for name, df in dataframes.items():
+        table = dataframe_to_arrow(df)
+        path = os.path.join(store_dir, f'{name}.arrow')
+        with pa.OSFile(f'{path}.tmp', 'wb') as sink:
+            with pa.ipc.new_file(sink, table.schema) as writer:
+                writer.write_table(table)
+        os.replace(f'{path}.tmp', path)
+
+
+def load_arrow_store(store_dir=ARROW_STORE_DIR, names=None, zero_copy=True):
+    """
+    Memory-map the tables written by export_arrow_store and return them as DataFrames.
+
+    With zero_copy (the default) every column is a pd.ArrowDtype view over the
+    mapped file, so nothing is copied and all processes reading the store share
+    one page-cache copy of it. zero_copy=False converts to the usual pandas dtypes
+    (category, datetime64, Int32, ...), which copies the data into this process.
+    names restricts the load to some of the tables. Requires pyarrow.
+    """
+    import pyarrow as pa
+
+    if names is None:
+        names = sorted(entry[:-len('.arrow')] for entry in os.listdir(store_dir)
+                       if entry.endswith('.arrow'))
+    dataframes = {}
+    for name in names:
+        source = pa.memory_map(os.path.join(store_dir, f'{name}.arrow'))
+        table = pa.ipc.open_file(source).read_all()
+        dataframes[name] = arrow_to_dataframe(table, zero_copy)
+    return dataframes
+
+
+def _join_key_values(series):
+    """
+    Return the keys of a join column as Python objects, packed ObjectIds as hex.
+    """
+    if _is_packed_oid(series):
+        return unpack_object_ids(series)
+    return series.astype(object)
+
+
+def _key_fingerprint(values):
+    """
+    Order-sensitive digest of the keys of a join column, as returned by
+    _join_key_values.
+    """
+    hashes = pd.util.hash_pandas_object(values, index=False).to_numpy()
+    return hashlib.sha256(hashes.tobytes()).hexdigest()[:16]
+
+
+def build_join_index(dataframes, join_keys=JOIN_KEYS):
+    """
+    Map every key of each domain in join_keys to a dense int32 surrogate and
+    precompute the sorted order of each key column.
+
+    Returns a flat dict of NumPy arrays:
+      'keys/<domain>'                sorted unique keys of the domain
+      'domain/<frame>/<column>'      name of the column's domain
+      'codes/<frame>/<column>'       int32 surrogate of each row's key (-1 when missing)
+      'order/<frame>/<column>'       row numbers sorted by surrogate
+      'offsets/<frame>/<column>'     start of each surrogate's rows within order
+      'rows/<frame>'                 number of rows of the frame
+      'fingerprint/<frame>/<column>' digest of the column's keys, in row order
+    With these, join_rows turns a string-keyed merge into integer gathers, and
+    check_join_index tells whether the index still matches the frames.
+    Packed ObjectId columns (see compact_schema) are keyed by their hex strings,
+    so they join with unpacked columns of the same domain.
+    """
+    index = {}
+    for domain, columns in join_keys.items():
+        present = {(frame, col): _join_key_values(dataframes[frame][col])
+                   for frame, col in columns
+                   if frame in dataframes and col in dataframes[frame].columns}
+        if not present:
+            continue
+        values = pd.concat(present.values())
+        keys = pd.Index(values.dropna().unique()).sort_values()
+        index[f'keys/{domain}'] = keys.to_numpy(dtype=str)
+        for (frame, col), column_values in present.items():
+            codes = keys.get_indexer(column_values).astype(np.int32)
+            order = np.argsort(codes, kind='stable').astype(np.int64)
+            counts = np.bincount(codes[codes >= 0], minlength=len(keys))
+            offsets = np.concatenate(([0], np.cumsum(counts))) + np.count_nonzero(codes < 0)
+            index[f'domain/{frame}/{col}'] = np.array(domain)
+            index[f'codes/{frame}/{col}'] = codes
+            index[f'order/{frame}/{col}'] = order
+            index[f'offsets/{frame}/{col}'] = offsets
+            index[f'rows/{frame}'] = np.array(len(column_values))
+            index[f'fingerprint/{frame}/{col}'] = np.array(_key_fingerprint(column_values))
+    return index
+
+
+def check_join_index(index, dataframes, frames=None):
+    """
+    Raise ValueError unless every frame of dataframes covered by the index (or
+    only those named in frames) has the row count and key columns the index was
+    built from.
+
+    Row numbers in a stale index, e.g. one saved before refresh_collection
+    replaced some receipts, point at the wrong rows; rebuild it with
+    build_join_index instead.
+    """
+    for name in index:
+        if not name.startswith('codes/'):
+            continue
+        _, frame, col = name.split('/', 2)
+        if frame not in dataframes or (frames is not None and frame not in frames):
+            continue
+        df = dataframes[frame]
+        if f'fingerprint/{frame}/{col}' not in index:
+            raise ValueError(f"The join index has no fingerprint of {frame}.{col}; rebuild it")
+        if int(index[f'rows/{frame}']) != len(df):
+            raise ValueError(f"The join index was built for {int(index[f'rows/{frame}'])} rows "
+                             f"of {frame}, which now has {len(df)}; rebuild it")
+        if col not in df.columns or (str(index[f'fingerprint/{frame}/{col}'])
+                                     != _key_fingerprint(_join_key_values(df[col]))):
+            raise ValueError(f"{frame}.{col} changed since the join index was built; rebuild it")
+
+
+def save_join_index(index, path):
+    """
+    Persist a join index built by build_join_index as an uncompressed .npz file.
+    """
+    np.savez(path, **index)
+
+
+def load_join_index(path, dataframes=None):
+    """
+    Load a join index written by save_join_index. Given the working dataframes,
+    it is checked against them with check_join_index first.
+    """
+    with np.load(path) as data:
+        index = {name: data[name] for name in data.files}
+    if dataframes is not None:
+        check_join_index(index, dataframes)
+    return index
+
+
+def join_rows(index, left, right):
+    """
+    Row numbers of the inner join of two key columns of the same domain.
+
+    left and right are (frame, column) pairs registered in the index. Returns
+    (left_rows, right_rows), the row positions of every matching pair, ordered by
+    left row. Each left row is looked up through the right column's offsets, so
+    one-to-many joins (e.g. receipts to their items) need no hashing at all.
+    The frames are not consulted, so check an index loaded from disk against
+    them first, see load_join_index.
+    """
+    if index[f'domain/{left[0]}/{left[1]}'] != index[f'domain/{right[0]}/{right[1]}']:
+        raise ValueError(f"{left} and {right} do not share a key domain")
+    left_codes = index[f'codes/{left[0]}/{left[1]}']
+    right_order = index[f'order/{right[0]}/{right[1]}']
+    right_offsets = index[f'offsets/{right[0]}/{right[1]}']
+    matched = np.flatnonzero(left_codes >= 0)
+    codes = left_codes[matched]
+    starts = right_offsets[codes]
+    counts = right_offsets[codes + 1] - starts
+    left_rows = np.repeat(matched, counts)
+    run_starts = np.repeat(np.cumsum(counts) - counts, counts)
+    right_rows = right_order[np.repeat(starts, counts) + np.arange(counts.sum()) - run_starts]
+    return left_rows, right_rows
+
+
+def join_frames(dataframes, index, left, right, suffixes=('', '_right')):
+    """
+    Inner-join two working DataFrames on key columns of the same domain using
+    join_rows, e.g.
+
+        join_frames(dataframes, index, ('receipts', 'userId'), ('users', '_id'))
+
+    Overlapping column names of the right frame get the second suffix. The two
+    frames are checked against the index with check_join_index first.
+    """
+    check_join_index(index, dataframes, (left[0], right[0]))
+    left_rows, right_rows = join_rows(index, left, right)
+    left_df = dataframes[left[0]].iloc[left_rows].reset_index(drop=True)
+    right_df = dataframes[right[0]].iloc[right_rows].reset_index(drop=True)
+    overlap = left_df.columns.intersection(right_df.columns)
+    right_df = right_df.rename(columns={col: f'{col}{suffixes[1]}' for col in overlap})
+    left_df = left_df.rename(columns={col: f'{col}{suffixes[0]}' for col in overlap})
+    return pd.concat([left_df, right_df], axis=1)
+
+
+def _strip_key(series):
+    """
+    Strip surrounding whitespace from a key column and treat empty keys as missing.
+    """
+    keys = series.astype(object).str.strip()
+    return keys.where(keys != '')
+
+
+def _brand_code_key(series):
+    """
+    Normalize brand codes: stripped, upper-cased, inner whitespace collapsed.
+    """
+    keys = _strip_key(series)
+    return keys.str.upper().str.replace(r'\s+', ' ', regex=True)
+
+
+KEY_NORMALIZERS = {'strip': _strip_key, 'brand_code': _brand_code_key}
+
+
+def match_items_to_brands(items_df, brands_df, rules=BRAND_MATCH_RULES):
+    """
+    Resolve each receipt item to the '_id' of a brand in one vectorized pass per rule.
+
+    Each rule of rules builds a hash index on a normalized brand column and looks
+    up the matching item column for the items still unmatched, so later rules act
+    as fallbacks. When several brands share a key, the first one in brands_df wins.
+    Returns a DataFrame aligned with items_df holding 'brand_id' and 'brand_match',
+    the item column that produced the match (missing when none did).
+    """
+    brand_ids = np.full(len(items_df), None, dtype=object)
+    provenance = np.full(len(items_df), None, dtype=object)
+    unmatched = np.ones(len(items_df), dtype=bool)
+    for item_col, brand_col, normalizer in rules:
+        if item_col not in items_df.columns or brand_col not in brands_df.columns:
+            continue
+        normalize = KEY_NORMALIZERS[normalizer]
+        brand_keys = normalize(brands_df[brand_col])
+        first = brand_keys.notna().to_numpy() & ~brand_keys.duplicated().to_numpy()
+        index = pd.Index(brand_keys[first])
+        positions = index.get_indexer(normalize(items_df[item_col][unmatched]))
+        found = positions >= 0
+        rows = np.flatnonzero(unmatched)[found]
+        brand_ids[rows] = brands_df['_id'].to_numpy()[first][positions[found]]
+        provenance[rows] = item_col
+        unmatched[rows] = False
+    return pd.DataFrame({
+        'brand_id': pd.Series(brand_ids, index=items_df.index, dtype=brands_df['_id'].dtype),
+        'brand_match': pd.Categorical(provenance, categories=[rule[0] for rule in rules]),
+    }, index=items_df.index)
+
+
+def brand_spend(items_df, brands_df, rules=BRAND_MATCH_RULES):
+    """
+    Roll up item spend per brand after match_items_to_brands.
+
+    Returns one row per matched brand with its name, the number of items and of
+    distinct receipts, the summed finalPrice (in cents) and quantityPurchased,
+    sorted by spend.
+    """
+    matches = match_items_to_brands(items_df, brands_df, rules)
+    items = items_df.assign(brand_id=matches['brand_id']).dropna(subset=['brand_id'])
+    rollup = items.groupby('brand_id').agg(
+        items=('receipt_id', 'size'),
+        receipts=('receipt_id', 'nunique'),
+        spend=('finalPrice', 'sum'),
+        quantity=('quantityPurchased', 'sum'),
+    )
+    names = brands_df.drop_duplicates('_id').set_index('_id')['name']
+    rollup.insert(0, 'name', names.reindex(rollup.index).to_numpy())
+    return rollup.sort_values('spend', ascending=False)
+
+
+def _bit_length(values):
+    """
+    Exact bit length of each uint64 in values, vectorized.
+    """
+    high = (values >> np.uint64(32)).astype(np.float64)
+    low = (values & np.uint64(0xFFFFFFFF)).astype(np.float64)
+    return np.where(high > 0, 32 + np.frexp(high)[1], np.frexp(low)[1])
+
+
+def hll_registers(values, groups, n_groups, precision=HLL_PRECISION):
+    """
+    Build one HyperLogLog sketch per group in a single vectorized pass.
+
+    values are hashed with pd.util.hash_array, which is stable across runs, and
+    groups gives the group number (0 .. n_groups-1) of each value. Returns a
+    (n_groups, 2**precision) uint8 array of registers; missing values are ignored.
+    """
+    values = pd.Series(values)
+    present = values.notna().to_numpy()
+    hashes = pd.util.hash_array(values[present].to_numpy(dtype=object))
+    groups = np.asarray(groups)[present]
+    shift = np.uint64(64 - precision)
+    buckets = (hashes >> shift).astype(np.int64)
+    rest = hashes & np.uint64((1 << (64 - precision)) - 1)
+    ranks = (64 - precision - _bit_length(rest) + 1).astype(np.uint8)
+    registers = np.zeros((n_groups, 1 << precision), dtype=np.uint8)
+    np.maximum.at(registers, (groups, buckets), ranks)
+    return registers
+
+
+def hll_estimate(registers):
+    """
+    Estimated distinct count of each HyperLogLog sketch (row) in registers, with
+    linear counting for small cardinalities.
+    """
+    registers = np.atleast_2d(registers)
+    m = registers.shape[1]
+    alpha = 0.7213 / (1 + 1.079 / m)
+    estimate = alpha * m * m / np.power(2.0, -registers.astype(np.float64)).sum(axis=1)
+    zeros = (registers == 0).sum(axis=1)
+    small = (estimate <= 2.5 * m) & (zeros > 0)
+    estimate[small] = m * np.log(m / zeros[small])
+    return estimate
+
+
+def _merge_sketches(sketches, groups, n_groups):
+    """
+    Combine HyperLogLog sketches stored as bytes, register by register, into
+    n_groups sketches; groups gives the target group of each sketch. Returns a
+    (n_groups, registers) uint8 array.
+    """
+    sketches = np.stack([np.frombuffer(sketch, dtype=np.uint8) for sketch in sketches])
+    registers = np.zeros((n_groups, sketches.shape[1]), dtype=np.uint8)
+    np.maximum.at(registers, groups, sketches)
+    return registers
+
+
+def _cube_rows(receipts_df, items_df, brands_df):
+    """
+    Rows feeding a receipt cube: one per receipt under ALL_BRANDS, plus one per
+    distinct (receipt, matched brand) pair, each carrying the receipt's measures.
+    """
+    receipts = receipts_df[['_id', 'userId', 'dateScanned', 'rewardsReceiptStatus',
+                            'totalSpent', 'purchasedItemCount', 'pointsEarned']]
+    receipts = receipts.assign(month=receipts['dateScanned'].dt.to_period('M').dt.to_timestamp())
+    matches = match_items_to_brands(items_df, brands_df)
+    pairs = pd.DataFrame({'_id': items_df['receipt_id'].to_numpy(),
+                          'brand_id': matches['brand_id'].to_numpy()})
+    pairs = pairs.dropna().drop_duplicates()
+    by_brand = receipts.merge(pairs, on='_id')
+    totals = receipts.assign(brand_id=ALL_BRANDS)
+    return pd.concat([totals, by_brand], ignore_index=True)
+
+
+def _aggregate_cube(rows, precision):
+    """
+    Aggregate cube rows by month, brand and status, sketching distinct users.
+    """
+    keys = ['month', 'brand_id', 'rewardsReceiptStatus']
+    grouped = rows.groupby(keys, observed=True, sort=True)
+    cube = grouped.agg(
+        receipts=('_id', 'size'),
+        receipts_with_total=('totalSpent', 'count'),
+        total_spent=('totalSpent', 'sum'),
+        purchased_items=('purchasedItemCount', 'sum'),
+        points_earned=('pointsEarned', 'sum'),
+    ).reset_index()
+    registers = hll_registers(rows['userId'], grouped.ngroup().to_numpy(), len(cube), precision)
+    cube['users_hll'] = [row.tobytes() for row in registers]
+    cube['users'] = hll_estimate(registers).round().astype(np.int64)
+    return cube
+
+
+def build_receipt_cube(receipts_df, items_df, brands_df, precision=HLL_PRECISION):
+    """
+    Materialize receipt aggregates keyed by month (of dateScanned) x brand x status.
+
+    Each row holds the number of receipts (and of those with a totalSpent), the
+    sums of totalSpent (in cents), purchasedItemCount and pointsEarned, and a
+    HyperLogLog sketch of the distinct userIds ('users_hll') with its estimate
+    ('users'). Brands come from match_items_to_brands, and a receipt counts once
+    for every brand it contains. Rows with brand_id == ALL_BRANDS aggregate whole
+    receipts, so per-status and per-month figures are not double counted. The
+    cube is a plain DataFrame; it can be stored with export_arrow_store and kept
+    current with update_receipt_cube.
+    """
+    return _aggregate_cube(_cube_rows(receipts_df, items_df, brands_df), precision)
+
+
+def merge_cubes(*cubes):
+    """
+    Merge receipt cubes over disjoint sets of receipts: measures add up and the
+    distinct-user sketches are combined register by register.
+    """
+    cube = pd.concat(cubes, ignore_index=True)
+    keys = ['month', 'brand_id', 'rewardsReceiptStatus']
+    grouped = cube.groupby(keys, observed=True, sort=True)
+    measures = ['receipts', 'receipts_with_total', 'total_spent', 'purchased_items', 'points_earned']
+    merged = grouped[measures].sum().reset_index()
+    registers = _merge_sketches(cube['users_hll'], grouped.ngroup().to_numpy(), len(merged))
+    merged['users_hll'] = [row.tobytes() for row in registers]
+    merged['users'] = hll_estimate(registers).round().astype(np.int64)
+    return merged
+
+
+def update_receipt_cube(cube, receipts_df, items_df, brands_df, since,
+                        precision=HLL_PRECISION):
+    """
+    Refresh a cube after new or changed receipts were loaded into receipts_df and
+    items_df (e.g. by refresh_collection).
+
+    Only the months holding receipts modified after since (compared with
+    modifyDate) are re-aggregated, from the receipts of those months alone, and
+    their rows replace the old ones. Sketches cannot subtract, so a month is
+    rebuilt rather than patched; a receipt is assumed to keep its dateScanned month.
+    """
+    changed = receipts_df['modifyDate'] > since
+    months = receipts_df.loc[changed, 'dateScanned'].dt.to_period('M').dt.to_timestamp().unique()
+    if not len(months):
+        return cube
+    in_months = receipts_df['dateScanned'].dt.to_period('M').dt.to_timestamp().isin(months)
+    receipts = receipts_df[in_months]
+    items = items_df[items_df['receipt_id'].isin(receipts['_id'])]
+    fresh = build_receipt_cube(receipts, items, brands_df, precision)
+    kept = cube[~cube['month'].isin(months)]
+    return pd.concat([kept, fresh], ignore_index=True).sort_values(
+        ['month', 'brand_id', 'rewardsReceiptStatus']).reset_index(drop=True)
+
+
+def top_brands_by_month(cube, brands_df=None, n=5, month=None):
+    """
+    Rank brands by receipts scanned in month (the latest month by default) next to
+    their rank in the previous month.
+    """
+    by_brand = cube[cube['brand_id'] != ALL_BRANDS]
+    counts = by_brand.groupby(['month', 'brand_id'])['receipts'].sum()
+    months = counts.index.get_level_values('month').unique().sort_values()
+    if month is None:
+        month = months[-1]
+    current = counts.xs(month, level='month').sort_values(ascending=False)
+    previous_month = month - pd.DateOffset(months=1)
+    if previous_month in months:
+        previous = counts.xs(previous_month, level='month').sort_values(ascending=False)
+    else:
+        previous = pd.Series(dtype=np.int64)
+    top = pd.DataFrame({'receipts': current.head(n)})
+    top['rank'] = np.arange(1, len(top) + 1)
+    previous_rank = pd.Series(np.arange(1, len(previous) + 1), index=previous.index)
+    top['previous_receipts'] = previous.reindex(top.index).to_numpy()
+    top['previous_rank'] = previous_rank.reindex(top.index).to_numpy()
+    if brands_df is not None:
+        names = brands_df.drop_duplicates('_id').set_index('_id')['name']
+        top.insert(0, 'name', names.reindex(top.index).to_numpy())
+    return top
+
+
+def average_spend_by_status(cube):
+    """
+    Average totalSpent per receipt for each rewardsReceiptStatus, in currency
+    units rather than cents, ignoring receipts without a totalSpent like
+    Series.mean does.
+    """
+    totals = cube[cube['brand_id'] == ALL_BRANDS]
+    grouped = totals.groupby('rewardsReceiptStatus', observed=True)[
+        ['total_spent', 'receipts_with_total']].sum().astype(np.float64)
+    return grouped['total_spent'] / CENTS_PER_UNIT / grouped['receipts_with_total']
+
+
+# Aggregations understood by the chunked aggregation engine, see partial_aggregate.
+AGGREGATIONS = ('sum', 'count', 'mean', 'min', 'max', 'distinct')
+# Spend per user over receipt chunks, for aggregate_file(receipts, ['userId'], ...).
+USER_SPEND_AGGS = {
+    'receipts': ('_id', 'count'),
+    'total_spent': ('totalSpent', 'sum'),
+    'average_spent': ('totalSpent', 'mean'),
+    'points_earned': ('pointsEarned', 'sum'),
+    'first_scanned': ('dateScanned', 'min'),
+    'last_scanned': ('dateScanned', 'max'),
+}
+# Spend per brand over item chunks from receipt_items_with_brands.
+BRAND_SPEND_AGGS = {
+    'items': ('receipt_id', 'count'),
+    'receipts': ('receipt_id', 'distinct'),
+    'spend': ('finalPrice', 'sum'),
+    'average_price': ('finalPrice', 'mean'),
+    'quantity': ('quantityPurchased', 'sum'),
+    'users': ('userId', 'distinct'),
+}
+
+
+def _partial_columns(aggs):
+    """
+    Return (partial column, source column, aggregation, merge) for each column of
+    a partial aggregate: a mean is kept as a sum and a count, and a 'distinct'
+    as a HyperLogLog sketch that merges register by register.
+    """
+    parts = []
+    for name, (col, func) in aggs.items():
+        if func not in AGGREGATIONS:
+            raise ValueError(f"Unknown aggregation {func!r} for {name}")
+        if func == 'mean':
+            parts.append((f'{name}.sum', col, 'sum', 'sum'))
+            parts.append((f'{name}.count', col, 'count', 'sum'))
+        elif func == 'count':
+            parts.append((name, col, 'count', 'sum'))
+        else:
+            parts.append((name, col, func, 'sketch' if func == 'distinct' else func))
+    return parts
+
+
+def _group_numbers(grouped):
+    """
+    Return the group number of every row of a GroupBy as int64, with -1 for the
+    rows left out because of a missing key.
+    """
+    return grouped.ngroup().fillna(-1).to_numpy(dtype=np.int64)
+
+
+def partial_aggregate(df, keys, aggs, precision=HLL_PRECISION, dropna=True):
+    """
+    Aggregate one chunk into a partial aggregate that merge_partials can combine
+    with those of other chunks.
+
+    keys are the group-by columns and aggs maps each output name to a (column,
+    aggregation) pair as in DataFrame.groupby().agg, the aggregation being one
+    of AGGREGATIONS. 'count' counts present values and 'distinct' estimates
+    distinct values with a HyperLogLog sketch of the given precision. Missing
+    source columns count as empty. Returns a DataFrame with the key columns and
+    one or more partial columns per aggregation.
+    """
+    parts = _partial_columns(aggs)
+    missing = {col for _, col, _, _ in parts if col not in df.columns}
+    if missing:
+        df = df.assign(**{col: np.nan for col in missing})
+    grouped = df.groupby(keys, observed=True, sort=True, dropna=dropna)
+    spec = {part: (col, func) for part, col, func, _ in parts if func != 'distinct'}
+    partial = grouped.agg(**spec) if spec else grouped.size().to_frame()[[]]
+    partial = partial.reset_index()
+    groups = _group_numbers(grouped)
+    for part, col, func, _ in parts:
+        if func == 'distinct':
+            present = groups >= 0
+            registers = hll_registers(df[col][present], groups[present], len(partial), precision)
+            partial[part] = [row.tobytes() for row in registers]
+    return partial
+
+
+def merge_partials(partials, keys, aggs, dropna=True):
+    """
+    Merge partial aggregates of disjoint chunks into one, group by group. None
+    entries are skipped; returns None when nothing is left.
+    """
+    partials = [partial for partial in partials if partial is not None]
+    if len(partials) > 1:
+        # Empty partials add no groups, and their sketch columns cannot be stacked.
+        partials = [partial for partial in partials if len(partial)] or partials[:1]
+    if len(partials) <= 1:
+        return partials[0] if partials else None
+    combined = pd.concat(partials, ignore_index=True)
+    grouped = combined.groupby(keys, observed=True, sort=True, dropna=dropna)
+    parts = _partial_columns(aggs)
+    ops = {part: merge for part, _, _, merge in parts if merge != 'sketch'}
+    merged = grouped.agg(ops) if ops else grouped.size().to_frame()[[]]
+    merged = merged.reset_index()
+    for part, _, _, merge in parts:
+        if merge == 'sketch':
+            merged[part] = [row.tobytes() for row in _merge_sketches(
+                combined[part], _group_numbers(grouped), len(merged))]
+    return merged
+
+
+def finalize_aggregate(partial, keys, aggs):
+    """
+    Turn a partial aggregate into the result: one row per group with the key
+    columns and one column per entry of aggs.
+    """
+    if partial is None or not len(partial):
+        return pd.DataFrame(columns=list(keys) + list(aggs))
+    result = partial[list(keys)].copy()
+    for name, (_, func) in aggs.items():
+        if func == 'mean':
+            total = partial[f'{name}.sum'].astype(np.float64)
+            result[name] = total / partial[f'{name}.count'].astype(np.float64)
+        elif func == 'distinct':
+            registers = np.stack([np.frombuffer(sketch, dtype=np.uint8) for sketch in partial[name]])
+            result[name] = hll_estimate(registers).round().astype(np.int64)
+        else:
+            result[name] = partial[name]
+    return result
+
+
+def _chunk_partial(df, keys, aggs, prepare, precision, dropna):
+    """
+    Apply prepare to one chunk and return its partial aggregate, or None when the
+    chunk has no rows, e.g. a block where no record passed the filters, which
+    has no columns to group by.
+    """
+    if not len(df):
+        return None
+    if prepare is not None:
+        df = prepare(df)
+        if not len(df):
+            return None
+    return partial_aggregate(df, keys, aggs, precision, dropna)
+
+
+def aggregate_chunks(chunks, keys, aggs, prepare=None, precision=HLL_PRECISION, dropna=True):
+    """
+    Aggregate an iterable of DataFrame chunks (e.g. from iter_chunks) by keys,
+    folding each chunk's partial aggregate into a running one, so memory holds
+    one chunk plus one row per group. prepare, if given, is applied to every
+    chunk first, e.g. receipt_items_with_brands. See partial_aggregate for aggs.
+    """
+    partial = None
+    for chunk in chunks:
+        partial = merge_partials([partial, _chunk_partial(chunk, keys, aggs, prepare, precision,
+                                                          dropna)], keys, aggs, dropna)
+    return finalize_aggregate(partial, keys, aggs)
+
+
+def _aggregate_block(block, file_path, object_hook, schema, columns, filters, strict, prepare,
+                     keys, aggs, precision, dropna):
+    """
+    Parse one block of JSON Lines and return its partial aggregate, or None if no
+    record of it is left. Runs inside the worker processes.
+    """
+    df = _parse_block(block, file_path, object_hook, schema, columns, filters, strict)
+    return _chunk_partial(df, keys, aggs, prepare, precision, dropna)
+
+
+def aggregate_file(file_path, keys, aggs, schema=None, prepare=None, chunksize=100_000,
+                   workers=None, chunk_bytes=CHUNK_BYTES, columns=None, filters=None,
+                   object_hook=decode_extended_json, precision=HLL_PRECISION, dropna=True,
+                   strict=False):
+    """
+    Aggregate a whole file by keys without loading it into memory.
+
+    Serially, the file is read with iter_chunks(file_path, chunksize, ...) and
+    folded by aggregate_chunks. With workers > 1 the decompressed stream is cut
+    into blocks of about chunk_bytes as in a parallel load_gzipped_json, and each
+    worker process parses, converts, prepares and partially aggregates its
+    blocks; the parent only merges the partials as they arrive. prepare must
+    then be picklable, e.g. a module-level function or a functools.partial of
+    one. schema, columns, filters and strict mean the same as for
+    load_gzipped_json.
+
+    For example, spend per user and per brand over the receipts history:
+
+        aggregate_file(path, ['userId'], USER_SPEND_AGGS, schema='receipts')
+        aggregate_file(path, ['brand_id'], BRAND_SPEND_AGGS, schema='receipts',
+                       prepare=functools.partial(receipt_items_with_brands,
+                                                 brands_df=brands_df))
+    """
+    if workers is None or workers <= 1:
+        chunks = iter_chunks(file_path, chunksize, object_hook, schema, columns=columns,
+                             filters=filters, strict=strict)
+        return aggregate_chunks(chunks, keys, aggs, prepare, precision, dropna)
+    filters = normalize_filters(filters)
+    _, parse_columns = _parse_columns(columns, None, filters)
+    partial = None
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        pending = deque()
+        for file_format, _, stream in _iter_streams(file_path):
+            if file_format == 'json':
+                records = filter_records(_iter_stream_records(
+                    file_format, stream, file_path, object_hook, parse_columns), filters)
+                df = _build_frame(list(records), schema, strict)
+                partial = merge_partials(
+                    [partial, _chunk_partial(df, keys, aggs, prepare, precision, dropna)],
+                    keys, aggs, dropna)
+                continue
+            for block in _iter_line_blocks(stream, chunk_bytes):
+                pending.append(pool.submit(_aggregate_block, block, file_path, object_hook, schema,
+                                           parse_columns, filters, strict, prepare, keys, aggs,
+                                           precision, dropna))
+                if len(pending) >= 2 * workers:
+                    partial = merge_partials([partial, pending.popleft().result()], keys, aggs, dropna)
+        for future in pending:
+            partial = merge_partials([partial, future.result()], keys, aggs, dropna)
+    return finalize_aggregate(partial, keys, aggs)
+
+
+def receipt_items_with_brands(receipts_df, brands_df, rules=BRAND_MATCH_RULES):
+    """
+    Normalize a chunk of receipts into its items, each carrying the receipt's
+    userId and the brand_id found by match_items_to_brands, for brand rollups
+    with aggregate_file.
+    """
+    items = normalize_receipt_items(receipts_df)
+    users = receipts_df.set_index('_id')['userId'] if 'userId' in receipts_df.columns else None
+    return items.assign(
+        brand_id=match_items_to_brands(items, brands_df, rules)['brand_id'],
+        userId=None if users is None else users.reindex(items['receipt_id']).to_numpy())
+
+
+# Define file paths for each dataset
+file_paths = {
+    'receipts': 'data/input_data/receipts.json.gz',
+    'users': 'data/input_data/users.json.gz',
+    'brands': 'data/input_data/brands.json.gz'
+}
+
+# Working DataFrames, each loaded, converted and split from its source file on
+# first access, reusing the on-disk cache when the inputs have not changed.
+dataframes = LazyFrames(file_paths)
+
+# Module-level names under which the working DataFrames were always available.
+_FRAME_ALIASES = {'receipts_df': 'receipts', 'users_df': 'users', 'brands_df': 'brands',
+                  'rewardsReceiptItemList_df': 'rewardsReceiptItemList_df', 'cpg_df': 'cpg_df'}
+
+
+def __getattr__(name):
+    """
+    Resolve receipts_df, users_df, ... lazily from dataframes on first use.
+    """
+    if name in _FRAME_ALIASES:
+        return dataframes[_FRAME_ALIASES[name]]
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
 
-# Apply conversions to each DataFrame.
-for name, df in dataframes.items():
-    dataframes[name] = apply_conversions(df)
 
-# for name, df in dataframes.items():
-#     print(f"First 10 rows of {name}:")
-#     print(df.head(10))
-#     print("Shape of the DataFrame:", df.shape, "\n")
+if __name__ == '__main__':
+    dataframes.load_all()
+    receipts_df = dataframes['receipts']
+    users_df = dataframes['users']
+    brands_df = dataframes['brands']
+    rewardsReceiptItemList_df = dataframes['rewardsReceiptItemList_df']
+    cpg_df = dataframes['cpg_df']
 
-print(cpg_df['cpg_ref'].value_counts())
+    # for name, df in dataframes.items():
+    #     print(f"First 10 rows of {name}:")
+    #     print(df.head(10))
+    #     print("Shape of the DataFrame:", df.shape, "\n")
 
-print(rewardsReceiptItemList)
\ No newline at end of file
+    print(cpg_df['cpg_ref'].value_counts())
+    print(rewardsReceiptItemList_df.head(10))
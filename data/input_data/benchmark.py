@@ -0,0 +1,293 @@
+"""
+Benchmarks for the load, convert and analytics stages of abc.py.
+
+Synthetic receipts/users/brands files are generated from the real ones at any
+scale, then each pipeline stage is timed and memory-profiled and the results are
+written as JSON for regression tracking. Run from the repository root, e.g.
+
+    python data/input_data/benchmark.py --receipts 1000000 --output bench.json
+"""
+import argparse
+import datetime
+import gzip
+import json
+import os
+import platform
+import random
+import resource
+import time
+import tracemalloc
+
+import numpy as np
+import pandas as pd
+
+from pipeline_loader import PIPELINE_PATH, load_pipeline
+
+
+SOURCE_DIR = os.path.dirname(PIPELINE_PATH)
+COLLECTIONS = ('receipts', 'users', 'brands')
+# Milliseconds by which synthetic dates are shifted at most, either way.
+DATE_JITTER_MS = 90 * 24 * 3600 * 1000
+
+
+def _new_object_id(rng, timestamp_ms):
+    """
+    Random ObjectId hex string whose embedded creation time is timestamp_ms.
+    """
+    return '%08x%016x' % (int(timestamp_ms // 1000) & 0xFFFFFFFF, rng.getrandbits(64))
+
+
+def _shift_dates(value, offset_ms):
+    """
+    Shift every {'$date': ...} inside a raw document by offset_ms.
+    """
+    if isinstance(value, dict):
+        if '$date' in value:
+            return {'$date': value['$date'] + offset_ms}
+        return {key: _shift_dates(item, offset_ms) for key, item in value.items()}
+    if isinstance(value, list):
+        return [_shift_dates(item, offset_ms) for item in value]
+    return value
+
+
+def _mix64(value):
+    """
+    splitmix64 finalizer: a well-spread 64-bit hash of a non-negative int.
+    """
+    value = (value + 0x9E3779B97F4A7C15) & 0xFFFFFFFFFFFFFFFF
+    value = ((value ^ (value >> 30)) * 0xBF58476D1CE4E5B9) & 0xFFFFFFFFFFFFFFFF
+    value = ((value ^ (value >> 27)) * 0x94D049BB133111EB) & 0xFFFFFFFFFFFFFFFF
+    return value ^ (value >> 31)
+
+
+def _synthetic_user(real_users, seed, number):
+    """
+    Return (real user, date offset in ms, ObjectId hex) of the number-th distinct
+    synthetic user.
+
+    All three are hashed from seed and number alone, so receipts can point at
+    any user by drawing a number instead of keeping every user id in memory.
+    """
+    first = _mix64((seed << 48) + 2 * number)
+    real_user = real_users[first % len(real_users)]
+    offset_ms = (first >> 16) % (2 * DATE_JITTER_MS + 1) - DATE_JITTER_MS
+    created_ms = real_user.get('createdDate', {}).get('$date')
+    timestamp_ms = 0 if created_ms is None else created_ms + offset_ms
+    object_id = '%08x%016x' % (int(timestamp_ms // 1000) & 0xFFFFFFFF,
+                               _mix64((seed << 48) + 2 * number + 1))
+    return real_user, offset_ms, object_id
+
+
+def generate_synthetic_data(pipeline, out_dir, n_receipts, seed=0, n_brands=None):
+    """
+    Write receipts/users/brands .json.gz files scaled to n_receipts receipts.
+
+    Records are sampled with replacement from the real files, so field sparsity
+    and the nested item-list distribution are kept. Users are scaled by their
+    real ratio to receipts, ids are regenerated, dates are jittered, and users
+    are duplicated at the real rate. Every receipt's userId points at a
+    synthetic user.
+
+    Brands are a dimension table: by default each real brand is written once
+    with a new id. n_brands sets their number instead; brands beyond the real
+    ones repeat real barcodes and brand codes, which match_items_to_brands only
+    matches once. Returns {collection: path}.
+    """
+    rng = random.Random(seed)
+    real = {name: list(pipeline.iter_json_records(os.path.join(SOURCE_DIR, f'{name}.json.gz')))
+            for name in COLLECTIONS}
+    scale = n_receipts / len(real['receipts'])
+    real_users = real['users']
+    duplicate_rate = 1 - len({user['_id']['$oid'] for user in real_users}) / len(real_users)
+    os.makedirs(out_dir, exist_ok=True)
+    paths = {name: os.path.join(out_dir, f'{name}.json.gz') for name in COLLECTIONS}
+
+    n_users = 0
+    with gzip.open(paths['users'], 'wt', encoding='utf-8') as f:
+        previous = None
+        for _ in range(max(1, round(len(real_users) * scale))):
+            if previous is not None and rng.random() < duplicate_rate:
+                f.write(previous)
+                continue
+            real_user, offset_ms, object_id = _synthetic_user(real_users, seed, n_users)
+            user = _shift_dates(real_user, offset_ms)
+            user['_id'] = {'$oid': object_id}
+            previous = json.dumps(user) + '\n'
+            n_users += 1
+            f.write(previous)
+
+    real_brands = real['brands']
+    if n_brands is None:
+        n_brands = len(real_brands)
+    brands = (rng.sample(real_brands, n_brands) if n_brands <= len(real_brands)
+              else real_brands + rng.choices(real_brands, k=n_brands - len(real_brands)))
+    with gzip.open(paths['brands'], 'wt', encoding='utf-8') as f:
+        for brand in brands:
+            brand = dict(brand)
+            brand['_id'] = {'$oid': _new_object_id(rng, time.time() * 1000)}
+            f.write(json.dumps(brand) + '\n')
+
+    with gzip.open(paths['receipts'], 'wt', encoding='utf-8') as f:
+        for _ in range(n_receipts):
+            receipt = _shift_dates(rng.choice(real['receipts']),
+                                   rng.randint(-DATE_JITTER_MS, DATE_JITTER_MS))
+            receipt['_id'] = {'$oid': _new_object_id(rng, receipt['dateScanned']['$date'])}
+            receipt['userId'] = _synthetic_user(real_users, seed, rng.randrange(n_users))[2]
+            f.write(json.dumps(receipt) + '\n')
+    return paths
+
+
+def run_stage(results, name, func, rows=None, trace_memory=True):
+    """
+    Run func(), append its timings and memory figures to results, and return its value.
+
+    rows is the number of rows the stage processed, or a callable computing it
+    from the return value; it gives the stage's rows/sec. cpu_s is the CPU time of
+    this process only; child_cpu_s is that of the worker processes the stage ran
+    and waited for.
+    """
+    if trace_memory:
+        tracemalloc.start()
+    wall_start = time.perf_counter()
+    cpu_start = time.process_time()
+    child_start = resource.getrusage(resource.RUSAGE_CHILDREN)
+    value = func()
+    wall = time.perf_counter() - wall_start
+    cpu = time.process_time() - cpu_start
+    child_end = resource.getrusage(resource.RUSAGE_CHILDREN)
+    child_cpu = (child_end.ru_utime + child_end.ru_stime
+                 - child_start.ru_utime - child_start.ru_stime)
+    peak = None
+    if trace_memory:
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    if callable(rows):
+        rows = rows(value)
+    results.append({
+        'stage': name,
+        'wall_s': round(wall, 6),
+        'cpu_s': round(cpu, 6),
+        'child_cpu_s': round(max(child_cpu, 0.0), 6),
+        'rows': rows,
+        'rows_per_s': round(rows / wall, 1) if rows and wall else None,
+        'peak_alloc_bytes': peak,
+        # ru_maxrss is in KiB on Linux.
+        'max_rss_bytes': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024,
+    })
+    print(f"{name}: {wall:.3f}s wall, {cpu:.3f}s cpu, rows={rows}")
+    return value
+
+
+def run_benchmarks(pipeline, paths, workers=None, trace_memory=True):
+    """
+    Time the pipeline stages over the files in paths and return the stage results.
+
+    For each count in workers, build_collection('receipts') is also timed with
+    that many worker processes. Its stage gets the speedup over the serial build
+    and speedup_bound, the serial wall time over the CPU time the parent process
+    spent inflating, dispatching and concatenating: however many cores there
+    are, the parallel build cannot be faster than that serial part.
+    """
+    results = []
+    raw = {}
+    for name in COLLECTIONS:
+        raw[name] = run_stage(results, f'load_gzipped_json[{name}]',
+                              lambda: pipeline.load_gzipped_json(paths[name]), len, trace_memory)
+    if workers:
+        run_stage(results, 'build_collection[receipts]',
+                  lambda: pipeline.build_collection('receipts', paths['receipts']),
+                  lambda frames: len(frames['receipts']), trace_memory)
+        serial = results[-1]
+        for count in workers:
+            run_stage(results, f'build_collection[receipts, workers={count}]',
+                      lambda: pipeline.build_collection('receipts', paths['receipts'],
+                                                        workers=count),
+                      lambda frames: len(frames['receipts']), trace_memory)
+            results[-1]['speedup'] = round(serial['wall_s'] / results[-1]['wall_s'], 2)
+            results[-1]['speedup_bound'] = round(serial['wall_s'] / results[-1]['cpu_s'], 2)
+    typed = {}
+    for name in COLLECTIONS:
+        typed[name] = run_stage(results, f'apply_conversions[{name}]',
+                                lambda: pipeline.apply_conversions(raw[name].copy(), name),
+                                len, trace_memory)
+    items = run_stage(results, 'normalize_receipt_items',
+                      lambda: pipeline.normalize_receipt_items(typed['receipts']), len, trace_memory)
+    frames = pipeline.split_collection('brands', typed['brands'])
+    frames.update(pipeline.split_collection('receipts', typed['receipts']))
+    frames['users'] = pipeline.dedupe_frame(typed['users'], **pipeline.DEDUPE_POLICIES['users'])[0]
+    run_stage(results, 'match_items_to_brands',
+              lambda: pipeline.match_items_to_brands(items, frames['brands']), len, trace_memory)
+    run_stage(results, 'brand_spend',
+              lambda: pipeline.brand_spend(items, frames['brands']), len(items), trace_memory)
+    index = run_stage(results, 'build_join_index',
+                      lambda: pipeline.build_join_index(frames), len(items), trace_memory)
+    run_stage(results, 'join_rows[receipts.userId=users._id]',
+              lambda: pipeline.join_rows(index, ('receipts', 'userId'), ('users', '_id')),
+              lambda rows: len(rows[0]), trace_memory)
+    cube = run_stage(results, 'build_receipt_cube',
+                     lambda: pipeline.build_receipt_cube(frames['receipts'], items, frames['brands']),
+                     len(frames['receipts']), trace_memory)
+    run_stage(results, 'top_brands_by_month',
+              lambda: pipeline.top_brands_by_month(cube), len(cube), trace_memory)
+    run_stage(results, 'average_spend_by_status',
+              lambda: pipeline.average_spend_by_status(cube), len(cube), trace_memory)
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--receipts', type=int, default=100000,
+                        help='number of synthetic receipts (e.g. 1000000, 10000000, 100000000)')
+    parser.add_argument('--brands', type=int, default=None,
+                        help='number of synthetic brands (default: as many as the real ones)')
+    parser.add_argument('--data-dir', default='data/benchmark',
+                        help='where synthetic files are written (reused if present)')
+    parser.add_argument('--regenerate', action='store_true',
+                        help='regenerate synthetic files even if they exist')
+    parser.add_argument('--workers', type=int, nargs='+', default=None,
+                        help='also time a parallel receipts build with each of these numbers '
+                             'of processes, e.g. --workers 2 4 8 16')
+    parser.add_argument('--no-trace-memory', action='store_true',
+                        help='skip tracemalloc, which slows allocation-heavy stages')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', default=None, help='JSON results file (default: stdout)')
+    parser.add_argument('--trace', default=None,
+                        help='also write the per-stage pipeline spans as Chrome-trace JSON')
+    args = parser.parse_args(argv)
+
+    pipeline = load_pipeline()
+    data_dir = os.path.join(args.data_dir, str(args.receipts))
+    if args.brands is not None:
+        data_dir += f'-brands{args.brands}'
+    paths = {name: os.path.join(data_dir, f'{name}.json.gz') for name in COLLECTIONS}
+    if args.regenerate or not all(os.path.exists(path) for path in paths.values()):
+        start = time.perf_counter()
+        paths = generate_synthetic_data(pipeline, data_dir, args.receipts, args.seed,
+                                        args.brands)
+        print(f"Generated synthetic data in {time.perf_counter() - start:.1f}s")
+
+    with pipeline.profile_stages() as pipeline_stages:
+        stages = run_benchmarks(pipeline, paths, args.workers, not args.no_trace_memory)
+    report = {
+        'timestamp': datetime.datetime.now(datetime.timezone.utc).isoformat(),
+        'receipts': args.receipts,
+        'brands': args.brands,
+        'workers': args.workers,
+        'files': {name: os.path.getsize(path) for name, path in paths.items()},
+        'python': platform.python_version(),
+        'pandas': pd.__version__,
+        'numpy': np.__version__,
+        'stages': stages,
+        'pipeline': pipeline.stage_report(pipeline_stages)['totals'],
+    }
+    if args.trace:
+        pipeline.write_stage_report(pipeline_stages, args.trace, 'chrome')
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
+
+
+if __name__ == '__main__':
+    main()
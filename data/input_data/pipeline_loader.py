@@ -0,0 +1,25 @@
+"""
+Import abc.py, which holds the shared loader and conversions, as the module
+'pipeline'. The scripts and tests next to it share this one loader.
+"""
+import importlib.util
+import os
+import sys
+
+
+PIPELINE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'abc.py')
+
+
+def load_pipeline():
+    """
+    Import abc.py under the name 'pipeline'; 'import abc' would find the standard
+    library module instead. Registering it in sys.modules lets worker processes
+    unpickle its functions. Later calls return the module already imported.
+    """
+    if 'pipeline' in sys.modules:
+        return sys.modules['pipeline']
+    spec = importlib.util.spec_from_file_location('pipeline', PIPELINE_PATH)
+    module = importlib.util.module_from_spec(spec)
+    sys.modules['pipeline'] = module
+    spec.loader.exec_module(module)
+    return module
@@ -0,0 +1,308 @@
+"""
+Regression and parity tests for abc.py. Run from the repository root with
+
+    python -m pytest data/input_data
+"""
+import functools
+import gzip
+import itertools
+import json
+import os
+import time
+
+import pandas as pd
+import pytest
+
+from pipeline_loader import load_pipeline
+
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+RECEIPTS = os.path.join(HERE, 'receipts.json.gz')
+USERS = os.path.join(HERE, 'users.json.gz')
+BRANDS = os.path.join(HERE, 'brands.json.gz')
+FILE_PATHS = {'receipts': RECEIPTS, 'users': USERS, 'brands': BRANDS}
+
+
+pipeline = load_pipeline()
+
+
+@pytest.mark.parametrize('first, second', [
+    ({'filters': [('rewardsReceiptStatus', '==', 'FINISHED')]}, {}),
+    ({}, {'filters': [('rewardsReceiptStatus', '==', 'FINISHED')]}),
+    ({}, {'columns': ['_id', 'totalSpent']}),
+])
+def test_cache_is_not_shared_across_load_arguments(tmp_path, first, second):
+    pytest.importorskip('pyarrow')
+    pipeline.load_collection('receipts', RECEIPTS, str(tmp_path), **first)
+    cached = pipeline.load_collection('receipts', RECEIPTS, str(tmp_path), **second)
+    fresh = pipeline.build_collection('receipts', RECEIPTS, **second)
+    pd.testing.assert_frame_equal(cached['receipts'], fresh['receipts'])
+    lazy = pipeline.LazyFrames(FILE_PATHS, str(tmp_path))
+    assert len(lazy['receipts']) == 1119
+
+
+def _brands():
+    brands = pipeline.load_gzipped_json(BRANDS, schema='brands')
+    return pipeline.split_collection('brands', brands)['brands']
+
+
+@pytest.mark.parametrize('status, keys, aggs, prepare', [
+    ('PENDING', ['rewardsReceiptStatus'],
+     {'n': ('_id', 'count'), 'spent': ('totalSpent', 'sum'), 'users': ('userId', 'distinct')},
+     None),
+    # PENDING receipts have no brand matches; 42 FLAGGED items do.
+    ('FLAGGED', ['brand_id'], {'items': ('receipt_id', 'count'), 'spend': ('finalPrice', 'sum')},
+     'receipt_items_with_brands'),
+])
+def test_parallel_aggregation_matches_serial_with_selective_filter(status, keys, aggs, prepare):
+    if prepare is not None:
+        prepare = functools.partial(getattr(pipeline, prepare), brands_df=_brands())
+    kwargs = dict(schema='receipts', prepare=prepare,
+                  filters=[('rewardsReceiptStatus', '==', status)])
+    serial = pipeline.aggregate_file(RECEIPTS, keys, aggs, chunksize=7, **kwargs)
+    parallel = pipeline.aggregate_file(RECEIPTS, keys, aggs, workers=2, chunk_bytes=5000,
+                                       **kwargs)
+    assert len(serial)
+    pd.testing.assert_frame_equal(parallel, serial, check_dtype=False, check_categorical=False)
+
+
+def _write_jsonl(path, records):
+    with gzip.open(path, 'wt', encoding='utf-8') as f:
+        for record in records:
+            f.write(json.dumps(record) + '\n')
+
+
+@pytest.mark.parametrize('others_change', [True, False])
+def test_refresh_drops_items_of_receipts_that_lost_them(tmp_path, others_change):
+    pytest.importorskip('pyarrow')
+    records = list(pipeline.iter_json_records(RECEIPTS))
+    source = str(tmp_path / 'receipts.json.gz')
+    _write_jsonl(source, records)
+    cache_dir = str(tmp_path / 'cache')
+    pipeline.refresh_collection('receipts', source, cache_dir)
+
+    latest = max(record['modifyDate']['$date'] for record in records)
+    emptied = next(i for i, record in enumerate(records) if record.get('rewardsReceiptItemList'))
+    records[emptied] = dict(records[emptied], modifyDate={'$date': latest + 1000})
+    del records[emptied]['rewardsReceiptItemList']
+    if others_change:
+        # Another changed receipt keeps its items, so the delta has the item column.
+        other = next(i for i, record in enumerate(records)
+                     if i != emptied and record.get('rewardsReceiptItemList'))
+        records[other] = dict(records[other], modifyDate={'$date': latest + 1000})
+    _write_jsonl(source, records)
+
+    refreshed = pipeline.refresh_collection('receipts', source, cache_dir)
+    rebuilt = pipeline.build_collection('receipts', source)
+    for frame, key in (('receipts', '_id'), ('rewardsReceiptItemList_df', 'receipt_id')):
+        assert len(refreshed[frame]) == len(rebuilt[frame])
+        assert set(refreshed[frame][key]) == set(rebuilt[frame][key])
+
+
+@pytest.mark.parametrize('name', ['receipts', 'users', 'brands'])
+def test_concatenated_chunks_match_eager_load(name):
+    eager = pipeline.load_gzipped_json(FILE_PATHS[name], schema=name)
+    with pipeline.profile_stages() as records:
+        chunks = list(pipeline.iter_chunks(FILE_PATHS[name], chunksize=100, schema=name))
+    combined = pipeline.concat_frames(chunks, name)
+    pd.testing.assert_frame_equal(combined[eager.columns], eager)
+    stages = [record for record in records if record['stage'].startswith('chunk[')]
+    assert len(stages) == len(chunks)
+    assert all(record['rows'] for record in stages)
+
+
+@pytest.mark.parametrize('dtype, expected, bad_values', [
+    ('Int32', [1, None, None, None, None, 7], 2),
+    ('Int64', [1, None, None, None, 3e10, 7], 1),
+    ('float64', [1, 1.5, None, None, 3e10, 7], 0),
+])
+def test_number_columns_mask_values_their_dtype_cannot_hold(dtype, expected, bad_values):
+    series = pd.Series(['1', '1.5', '', None, '3e10', '7'], dtype=object, name='n')
+    result = pipeline.decode_number_column(series, dtype)
+    pd.testing.assert_series_equal(result, pd.Series(expected, name='n').astype(dtype))
+    assert result.attrs['bad_values'] == bad_values
+    if bad_values:
+        with pytest.raises(ValueError):
+            pipeline.decode_number_column(series, dtype, strict=True)
+
+
+def _receipts_with_bad_values(path, n, step, **bad):
+    """
+    Write the first n receipts to path with the given fields of every step-th one set
+    to text that is not a number.
+    """
+    records = list(itertools.islice(pipeline.iter_json_records(RECEIPTS), n))
+    for record in records[::step]:
+        record.update(bad)
+    _write_jsonl(path, records)
+    return str(path)
+
+
+def test_bad_values_are_only_reported_for_number_columns(tmp_path, capsys):
+    path = _receipts_with_bad_values(tmp_path / 'receipts.json.gz', 20, 10, totalSpent='n/a')
+    df = pipeline.load_gzipped_json(path, schema='receipts')
+    assert df.attrs['bad_values'] == {'totalSpent': 2}
+    assert capsys.readouterr().out == 'Masked 2 bad values in totalSpent\n'
+
+
+def test_bad_values_add_up_across_blocks_and_strict_reaches_every_load(tmp_path):
+    path = _receipts_with_bad_values(tmp_path / 'receipts.json.gz', 400, 50, totalSpent='n/a',
+                                     pointsEarned='')
+    serial = pipeline.load_gzipped_json(path, schema='receipts')
+    parallel = pipeline.load_gzipped_json(path, schema='receipts', workers=2, chunk_bytes=20_000)
+    chunks = list(pipeline.iter_chunks(path, chunksize=100, schema='receipts'))
+    assert serial.attrs['bad_values'] == {'totalSpent': 8}
+    assert parallel.attrs['bad_values'] == serial.attrs['bad_values']
+    assert pipeline.concat_frames(chunks, 'receipts').attrs['bad_values'] == {'totalSpent': 8}
+    loads = [
+        lambda: pipeline.load_gzipped_json(path, schema='receipts', strict=True),
+        lambda: pipeline.load_gzipped_json(path, schema='receipts', strict=True, workers=2,
+                                           chunk_bytes=20_000),
+        lambda: list(pipeline.iter_chunks(path, schema='receipts', strict=True)),
+        lambda: pipeline.load_collection('receipts', path, str(tmp_path), strict=True),
+        lambda: pipeline.aggregate_file(path, ['userId'], pipeline.USER_SPEND_AGGS,
+                                        schema='receipts', strict=True),
+        lambda: pipeline.aggregate_file(path, ['userId'], pipeline.USER_SPEND_AGGS,
+                                        schema='receipts', strict=True, workers=2,
+                                        chunk_bytes=20_000),
+    ]
+    for load in loads:
+        with pytest.raises(ValueError):
+            load()
+
+
+def test_items_of_compact_receipts_keep_packed_receipt_ids():
+    pytest.importorskip('pyarrow')
+    compact = pipeline.load_gzipped_json(RECEIPTS, schema=pipeline.compact_schema('receipts'))
+    receipts = pipeline.load_gzipped_json(RECEIPTS, schema='receipts')
+    packed = pipeline.normalize_receipt_items(compact)['receipt_id']
+    plain = pipeline.normalize_receipt_items(receipts)['receipt_id']
+    assert packed.dtype == compact['_id'].dtype
+    assert list(pipeline.unpack_object_ids(packed)) == list(plain)
+
+
+@pytest.mark.parametrize('name', ['receipts', 'users', 'brands'])
+@pytest.mark.parametrize('typed', [False, True])
+def test_parallel_load_matches_serial(name, typed):
+    schema = name if typed else None
+    serial = pipeline.load_gzipped_json(FILE_PATHS[name], schema=schema)
+    parallel = pipeline.load_gzipped_json(FILE_PATHS[name], schema=schema, workers=2,
+                                          chunk_bytes=20_000)
+    pd.testing.assert_frame_equal(parallel, serial)
+
+
+@pytest.mark.parametrize('name, load_kwargs', [
+    ('receipts', {}),
+    ('receipts', {'columns': ['_id', 'rewardsReceiptItemList'],
+                  'filters': [('rewardsReceiptStatus', '==', 'FLAGGED')]}),
+    ('users', {}),
+    ('brands', {}),
+])
+def test_parallel_build_matches_serial(name, load_kwargs):
+    serial = pipeline.build_collection(name, FILE_PATHS[name], **load_kwargs)
+    parallel = pipeline.build_collection(name, FILE_PATHS[name], workers=2, chunk_bytes=20_000,
+                                         **load_kwargs)
+    assert list(parallel) == list(serial)
+    for frame in serial:
+        pd.testing.assert_frame_equal(parallel[frame], serial[frame])
+
+
+@pytest.mark.parametrize('policy', [
+    {'keep': 'first'},
+    {'keep': 'latest', 'order_by': 'lastLogin'},
+])
+def test_dedupe_frame_matches_dedupe_records(policy):
+    records = list(pipeline.iter_json_records(USERS, pipeline.decode_extended_json))
+    expected = pd.DataFrame(list(pipeline.dedupe_records(iter(records), **policy)))
+    deduped, dropped = pipeline.dedupe_frame(pd.DataFrame(records), **policy)
+    assert dropped == len(records) - len(expected) > 0
+    pd.testing.assert_frame_equal(deduped, expected)
+
+
+def _frames(packed=()):
+    """
+    The working DataFrames of every collection, those named in packed loaded with
+    compact_schema.
+    """
+    frames = {}
+    for name in ('receipts', 'users', 'brands'):
+        schema = pipeline.compact_schema(name) if name in packed else name
+        df = pipeline.load_gzipped_json(FILE_PATHS[name], schema=schema,
+                                        dedupe=pipeline.DEDUPE_POLICIES.get(name))
+        frames.update(pipeline.split_collection(name, df))
+    return frames
+
+
+@pytest.mark.parametrize('packed', [(), ('receipts',), ('receipts', 'users', 'brands')])
+@pytest.mark.parametrize('left, right', [
+    (('receipts', '_id'), ('rewardsReceiptItemList_df', 'receipt_id')),
+    (('receipts', 'userId'), ('users', '_id')),
+    (('rewardsReceiptItemList_df', 'barcode'), ('brands', 'barcode')),
+])
+def test_join_rows_matches_merge(left, right, packed):
+    if packed:
+        pytest.importorskip('pyarrow')
+    frames = _frames()
+    index = pipeline.build_join_index(_frames(packed) if packed else frames)
+    left_rows, right_rows = pipeline.join_rows(index, left, right)
+    # pd.merge would pair missing keys with each other; join_rows never matches them.
+    keys = [frames[frame][column].astype(object).reset_index(drop=True).rename('key')
+            .rename_axis(f'{side}_row').dropna().reset_index()
+            for side, (frame, column) in zip(('left', 'right'), (left, right))]
+    merged = keys[0].merge(keys[1], on='key')
+    merged = merged.sort_values(['left_row', 'right_row'], ignore_index=True)
+    assert len(merged)
+    assert list(left_rows) == list(merged['left_row'])
+    assert list(right_rows) == list(merged['right_row'])
+
+
+def test_saved_join_index_is_refused_after_a_refresh(tmp_path):
+    pytest.importorskip('pyarrow')
+    records = list(pipeline.iter_json_records(RECEIPTS))
+    source = tmp_path / 'receipts.json.gz'
+    _write_jsonl(source, records)
+    cache_dir = str(tmp_path / 'cache')
+    frames = pipeline.refresh_collection('receipts', str(source), cache_dir)
+    path = str(tmp_path / 'index.npz')
+    pipeline.save_join_index(pipeline.build_join_index(frames), path)
+    join = ('receipts', '_id'), ('rewardsReceiptItemList_df', 'receipt_id')
+    index = pipeline.load_join_index(path, frames)
+    joined = pipeline.join_frames(frames, index, *join)
+    assert len(joined) == len(frames['rewardsReceiptItemList_df'])
+    # Touch one receipt: the refresh moves it to the end, keeping every row count.
+    changed = next(record for record in records if record.get('rewardsReceiptItemList'))
+    latest = max(record['modifyDate']['$date'] for record in records)
+    changed['modifyDate'] = {'$date': latest + 1000}
+    _write_jsonl(source, records)
+    refreshed = pipeline.refresh_collection('receipts', str(source), cache_dir)
+    assert len(refreshed['receipts']) == len(frames['receipts'])
+    with pytest.raises(ValueError):
+        pipeline.load_join_index(path, refreshed)
+    with pytest.raises(ValueError):
+        pipeline.join_frames(refreshed, index, *join)
+
+
+def test_concurrent_stages_report_their_own_cpu_time():
+    cpu_start = time.process_time()
+    with pipeline.profile_stages() as records:
+        pipeline.load_collections(FILE_PATHS, cache_dir=None)
+    process_cpu = time.process_time() - cpu_start
+    loads = [record for record in records if record['stage'].startswith('load_gzipped_json')]
+    assert len(loads) == 3
+    # Process-wide CPU time would count every overlapping thread in each stage.
+    assert sum(record['cpu_s'] for record in loads) <= process_cpu + 0.01
+
+
+def test_membership_tests_do_not_load_frames():
+    frames = pipeline.LazyFrames(FILE_PATHS, cache_dir=None)
+    assert 'receipts' in frames
+    assert 'cpg_df' in frames.keys()
+    assert 'missing' not in frames
+    assert frames.loaded() == []
+
+
+def test_load_collections_refuses_process_pools():
+    with pytest.raises(ValueError):
+        pipeline.load_collections(FILE_PATHS, cache_dir=None, workers=2)
+    frames = pipeline.LazyFrames(FILE_PATHS, cache_dir=None, workers=2).load_all()
+    assert len(frames['receipts']) == 1119